@@ -0,0 +1,164 @@
+# =-=-=-=-==-=-=-=-=-=
+# Actigraphy & Events
+# =-=-=-=-==-=-=-=-=-=
+#
+# After the fixed columns, every header row of the export carries one column
+# per actigraphy sample (labelled with its wall-clock time, e.g. "23:15") and
+# one "Event" column per event (values like "DEEP_START-1700000000000" or
+# "HR-1700000000000-57.0").
+#
+# This module pulls those out of a header/value row pair and packs them into
+# compact binary blobs for the sleep_actigraphy table:
+#
+#   samples  little-endian float32, one per actigraphy column
+#   events   EVENT_DTYPE records: kind code, time in ms, optional value
+#
+# Readers get NumPy views straight over the stored bytes, no copies.
+
+import re
+
+import numpy as np
+
+# Codes are the index in this tuple; never reorder, only append
+EVENT_KINDS = (
+    'UNKNOWN', 'LIGHT_START', 'LIGHT_END', 'DEEP_START', 'DEEP_END', 'REM_START', 'REM_END',
+    'AWAKE_START', 'AWAKE_END', 'TRACKING_PAUSED', 'TRACKING_RESUMED', 'TRACKING_STOPPED_BY_USER',
+    'SNORING', 'TALK', 'SOUND_EVENT_BABY', 'SOUND_EVENT_COUGH', 'SOUND_EVENT_LAUGH', 'SICK',
+    'LULLABY_START', 'LULLABY_STOP', 'LULLABY_VOLUME_DOWN', 'ALARM_STARTED', 'ALARM_SNOOZE',
+    'ALARM_SNOOZE_CANCELED', 'ALARM_DISMISS', 'HR', 'DHR', 'SPO2', 'RR', 'LUX', 'APNEA',
+    'WALKING_START', 'WALKING_END', 'BROKEN_START', 'BROKEN_END', 'POSITION',
+)
+EVENT_CODES = {name: code for code, name in enumerate(EVENT_KINDS)}
+EVENT_DTYPE = np.dtype([('kind', 'u1'), ('time', '<i8'), ('value', '<f4')])
+SAMPLE_DTYPE = np.dtype('<f4')
+SAMPLE_LABEL = re.compile(r'^\d{1,2}:\d{2}$')
+# A run of sample labels joined with commas
+SAMPLE_RUN = re.compile(r'(?:\d{1,2}:\d{2},)*\d{1,2}:\d{2}')
+
+
+# (header length, first Event column) -> first sample column, see column_layout
+_layouts = {}
+
+
+def column_layout(header):
+    # (first sample column, first Event column) for the layout exports use:
+    # the fixed columns, one run of sample columns, then only Event columns.
+    # The sample labels are wall-clock times that differ from record to
+    # record, so a layout is cached by the header's length and first Event
+    # column, and a header that hits the cache only has the labels around
+    # its boundaries checked. None for any other layout.
+    try:
+        event_start = header.index('Event')
+    except ValueError:
+        event_start = len(header)
+    if header.count('Event') != len(header) - event_start:
+        return None
+
+    key = (len(header), event_start)
+    sample_start = _layouts.get(key)
+    if sample_start is not None and (
+            sample_start == event_start
+            or (SAMPLE_LABEL.match(header[sample_start]) and SAMPLE_LABEL.match(header[event_start - 1])
+                and (sample_start == 0 or not SAMPLE_LABEL.match(header[sample_start - 1])))):
+        return sample_start, event_start
+
+    sample_start = event_start
+    for index in range(event_start):
+        if SAMPLE_LABEL.match(header[index]):
+            sample_start = index
+            break
+    if sample_start < event_start and not SAMPLE_RUN.fullmatch(','.join(header[sample_start:event_start])):
+        return None
+    _layouts[key] = sample_start
+    return sample_start, event_start
+
+
+def parse_samples(values):
+    try:
+        # Through float64 like float(), so the float32 values come out the
+        # same as parsing them one at a time
+        return np.array(values, dtype=np.float64).astype(SAMPLE_DTYPE)
+    except ValueError:
+        samples = []
+        for value in values:
+            try:
+                samples.append(float(value))
+            except ValueError:
+                samples.append(np.nan)
+        return np.array(samples, dtype=SAMPLE_DTYPE)
+
+
+def parse_events(values):
+    # "NAME-ms" or "NAME-ms-value" strings; ones that don't parse are skipped
+    events = []
+    nan = np.nan
+    for value in values:
+        parts = value.split('-', 2)
+        try:
+            events.append((EVENT_CODES.get(parts[0], 0), int(parts[1]),
+                           float(parts[2]) if len(parts) == 3 and parts[2] else nan))
+        except (ValueError, IndexError):
+            continue
+    return np.array(events, dtype=EVENT_DTYPE)
+
+
+def parse_actigraphy(header, values):
+    # Returns (samples, events) for one header/value row pair
+    layout = column_layout(header)
+    if layout is None:
+        return parse_actigraphy_columns(header, values)
+    sample_start, event_start = layout
+    return parse_samples(values[sample_start:event_start]), parse_events(values[event_start:len(header)])
+
+
+def parse_actigraphy_columns(header, values):
+    # parse_actigraphy for any layout, looking at the label of every column
+    samples = []
+    events = []
+    for label, value in zip(header, values):
+        if label == 'Event':
+            events.append(value)
+        elif SAMPLE_LABEL.match(label):
+            samples.append(value)
+    return parse_samples(samples), parse_events(events)
+
+
+def pack_samples(samples):
+    return np.asarray(samples, dtype=SAMPLE_DTYPE).tobytes()
+
+
+def pack_events(events):
+    return np.asarray(events, dtype=EVENT_DTYPE).tobytes()
+
+
+def unpack_samples(data):
+    # Read-only view over the bytes, no copy
+    return np.frombuffer(data, dtype=SAMPLE_DTYPE)
+
+
+def unpack_events(data):
+    return np.frombuffer(data, dtype=EVENT_DTYPE)
+
+
+def event_names(events):
+    return [EVENT_KINDS[kind] for kind in events['kind']]
+
+
+async def fetch_actigraphy(conn, user_id, start_times=None):
+    # {start_time: (samples, events)} for the given records of a user, or all
+    # of them. conn can be a connection or a pool.
+    if start_times is None:
+        rows = await conn.fetch(
+            "SELECT start_time, samples, events FROM sleep_actigraphy WHERE user_id = $1 ORDER BY start_time", user_id
+        )
+    else:
+        rows = await conn.fetch("""
+            SELECT start_time, samples, events FROM sleep_actigraphy
+            WHERE user_id = $1 AND start_time = ANY($2::timestamptz[])
+            ORDER BY start_time
+        """, user_id, list(start_times))
+
+    return {
+        row['start_time']: (unpack_samples(row['samples']), unpack_events(row['events']))
+        for row in rows
+    }
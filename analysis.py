@@ -1,5 +1,5 @@
 # big todos:
-# - sleep data analysis on sleep quality not just quantity
+# - sleep data analysis on sleep quality not just quantity (started: movement-based stats in sleep_quality.py)
 # - make code more robust (error handling, checking values, etc)
 # - optimisations? probably?
 # - clean up code (this kinda comes under optimisations tho lol :p)
@@ -7,14 +7,22 @@
 # - add a stat for least amount that was slept in one night during a time period and when? that would be nice
 
 from rich import print
+import argparse
 import os
 import zipfile
 from dotenv import load_dotenv
-import csv
 from datetime import datetime
 from pytz import timezone
 from datetime import datetime, timedelta
 import requests
+import time
+from datetime import timezone as dt_timezone
+from sleep_columns import load_sleep_columns
+from sleep_quality import analyze_quality
+import sqlite_store
+import online_stats
+import users
+import numpy as np
 
 def send_discord_message(message):
     """
@@ -31,54 +39,117 @@ def send_discord_message(message):
         "content": message
     }
 
-    try:
-        response = requests.post(webhook, json=data)
-        response.raise_for_status()
-        print("Message sent to Discord successfully!")
-    except requests.exceptions.RequestException as e:
-        print(f"Error sending message to Discord: {e}")
-
-# Parse a single sleep record and return a dictionary or object
-# containing the relevant information
-def parse_sleep_record(record):
-    sleep_data = {}
-
-    # Extract the timezone
-    tz_str = record[1]  # 'Tz' field
-    tz = timezone(tz_str)
-
-    # Extract the start time
-    start_time_str = record[2]  # 'From' field
-    start_time = datetime.strptime(start_time_str, '%d. %m. %Y %H:%M')
-    sleep_data['start_time'] = tz.localize(start_time)
-
-    # Extract the end time
-    end_time_str = record[3]  # 'To' field
-    end_time = datetime.strptime(end_time_str, '%d. %m. %Y %H:%M')
-    sleep_data['end_time'] = tz.localize(end_time)
-
-    # Extract the LenAdjust value (minutes spent awake during sleep record (as a negative))
-    len_adjust_str = record[13]  # 'LenAdjust' field
-    if len_adjust_str == '-1.0':
-        sleep_data['len_adjust'] = None  # Manually added record, data not available
-    else:
-        sleep_data['len_adjust'] = int(float(len_adjust_str))
+    for attempt in range(5):
+        try:
+            response = requests.post(webhook, json=data)
+            if response.status_code == 429:
+                # Rate limited, wait as long as Discord asks us to
+                delay = float(response.headers.get('Retry-After', 1))
+                print(f"Rate limited by Discord, retrying in {delay:.2f}s")
+                time.sleep(delay)
+                continue
+            response.raise_for_status()
+            print("Message sent to Discord successfully!")
+            return
+        except requests.exceptions.RequestException as e:
+            print(f"Error sending message to Discord: {e}")
+            return
+
+    print("Giving up sending message to Discord after being rate limited")
+
+def build_sleep_timeline(sleep_records):
+    """
+    Builds sorted prefix sums over the sleep records so the amount slept
+    between any two instants can be looked up with a binary search.
+
+    Every record spreads its sleep (duration plus the negative LenAdjust
+    minutes) evenly over its start..end span. Sleep up to an instant t is
+
+        sum(sleep of records ended by t)
+        + sum(rate * (t - start) over records still running at t)
+
+    and both sums fall out of prefix sums over the records sorted by start
+    and by end, which also copes with overlapping records.
+    """
+    count = len(sleep_records)
+    starts = np.empty(count)
+    ends = np.empty(count)
+    sleep = np.empty(count)
+
+    for index, record in enumerate(sleep_records):
+        starts[index] = record['start_time'].timestamp()
+        ends[index] = record['end_time'].timestamp()
+        sleep[index] = ends[index] - starts[index]
+        if record['len_adjust'] is not None:
+            sleep[index] += record['len_adjust'] * 60
+
+    # Work relative to the first record to keep the products small
+    origin = starts.min() if count else 0.0
+    starts -= origin
+    ends -= origin
+    spans = ends - starts
+    rates = np.divide(sleep, spans, out=np.zeros(count), where=spans > 0)
+    # Zero-length records count in full once they've ended
+    ended_sleep = np.where(spans > 0, rates * spans, sleep)
+
+    by_start = np.argsort(starts, kind='stable')
+    by_end = np.argsort(ends, kind='stable')
+
+    def prefix(values):
+        return np.concatenate(([0.0], np.cumsum(values)))
+
+    return {
+        'origin': origin,
+        'starts': starts[by_start],
+        'ends': ends[by_end],
+        'rate_by_start': prefix(rates[by_start]),
+        'rate_start_by_start': prefix(rates[by_start] * starts[by_start]),
+        'rate_by_end': prefix(rates[by_end]),
+        'rate_start_by_end': prefix(rates[by_end] * starts[by_end]),
+        'sleep_by_end': prefix(ended_sleep[by_end]),
+    }
+
+
+def sleep_seconds_until(timeline, instants):
+    """
+    Total seconds slept before each of the given epoch timestamps.
+    """
+    t = np.asarray(instants, dtype=float) - timeline['origin']
+    started = np.searchsorted(timeline['starts'], t, side='right')
+    ended = np.searchsorted(timeline['ends'], t, side='right')
+
+    running_rate = timeline['rate_by_start'][started] - timeline['rate_by_end'][ended]
+    running_rate_start = timeline['rate_start_by_start'][started] - timeline['rate_start_by_end'][ended]
+    return timeline['sleep_by_end'][ended] + t * running_rate - running_rate_start
+
+
+def window_sleep_seconds(timeline, window_starts, window_ends):
+    """
+    Seconds slept inside each [start, end) window. Records straddling a window
+    boundary only count for the part that falls inside the window.
+    """
+    return sleep_seconds_until(timeline, window_ends) - sleep_seconds_until(timeline, window_starts)
+
+
+def daily_sleep_seconds(timeline, days, now=None):
+    """
+    Rolling series of seconds slept in each of the last `days` 24h periods
+    ending at `now`, oldest first.
+    """
+    now = (now or datetime.now(timezone('UTC'))).timestamp()
+    boundaries = now - 86400 * np.arange(days, -1, -1)
+    return np.diff(sleep_seconds_until(timeline, boundaries))
 
-    return sleep_data
 
 # Calculate the sleep to awake ratio given sleep records data and a time period
-def calculate_sleep_awake_ratio(sleep_records, time_period):
-    end_time = datetime.now(timezone('UTC'))
+def calculate_sleep_awake_ratio(sleep_records, time_period, now=None, timeline=None):
+    if timeline is None:
+        timeline = build_sleep_timeline(sleep_records)
+    end_time = now or datetime.now(timezone('UTC'))
     start_time = end_time - timedelta(days=time_period)
 
-    total_sleep_duration = timedelta()
-
-    for record in sleep_records:
-        if record['start_time'] >= start_time:
-            sleep_duration = record['end_time'] - record['start_time']
-            if record['len_adjust'] is not None:
-                sleep_duration += timedelta(minutes=record['len_adjust'])
-            total_sleep_duration += sleep_duration
+    sleep_seconds = window_sleep_seconds(timeline, [start_time.timestamp()], [end_time.timestamp()])[0]
+    total_sleep_duration = timedelta(seconds=float(sleep_seconds))
 
     total_duration = timedelta(days=time_period)
     total_awake_duration = total_duration - total_sleep_duration
@@ -88,27 +159,19 @@ def calculate_sleep_awake_ratio(sleep_records, time_period):
 
     return sleep_ratio, awake_ratio, total_sleep_duration
 
-def analyze_sleep_data(sleep_records):
-    time_periods = [1, 3, 7]  # 24 hours, 3 days, 7 days
-    analysis_results = {}
-
-    for period in time_periods:
-        sleep_ratio, awake_ratio = calculate_sleep_awake_ratio(sleep_records, period)
-        analysis_results[period] = {
-            'sleep_ratio': sleep_ratio,
-            'awake_ratio': awake_ratio
-        }
-
-    return analysis_results
-
 # Perform analysis on the parsed sleep records
 # Calculate statistics, identify patterns, etc.
-def analyze_sleep_data(sleep_records):
-    time_periods = [1, 3, 7]  # 24 hours, 3 days, 7 days
+def analyze_sleep_data(sleep_records, time_periods=(1, 3, 7), now=None):
+    # Defaults to 24 hours, 3 days, 7 days; any number of trailing windows
+    # is answered from one sorted timeline
+    timeline = build_sleep_timeline(sleep_records)
+    end_time = now or datetime.now(timezone('UTC'))
     analysis_results = {}
 
     for period in time_periods:
-        sleep_ratio, awake_ratio, total_sleep_duration = calculate_sleep_awake_ratio(sleep_records, period)
+        sleep_ratio, awake_ratio, total_sleep_duration = calculate_sleep_awake_ratio(
+            sleep_records, period, now=end_time, timeline=timeline
+        )
         analysis_results[period] = {
             'sleep_ratio': sleep_ratio,
             'awake_ratio': awake_ratio,
@@ -130,12 +193,8 @@ def generate_report(analysis_results):
 
         if period == 1:
             period_label = "24h"
-        elif period == 3:
-            period_label = "3d"
-        elif period == 7:
-            period_label = "7d"
         else:
-            raise ValueError(f"Unsupported time period: {period}")
+            period_label = f"{period}d"
 
         report += f"--=--=--=    {period_label}    =--=--=--\n"
         report += f"asleep percent: {sleep_ratio:.2f}%\n"
@@ -160,28 +219,105 @@ def generate_report(analysis_results):
 
 
 
-def process_sleep_data(csv_file):
+def load_sleep_records(csv_file):
+    """
+    Loads the records needed for the analysis using the columnar loader,
+    which parses all times at once instead of a strptime + localize for
+    From and To on every row.
+    """
+    columns = load_sleep_columns(csv_file, with_actigraphy=True)
     sleep_records = []
 
-    with open(csv_file, 'r') as file:
-        csv_reader = csv.reader(file)
+    for start, end, len_adjust, samples in zip(columns['start'].tolist(), columns['end'].tolist(),
+                                               columns['len_adjust'].tolist(), columns['actigraphy']):
+        sleep_records.append({
+            'start_time': datetime.fromtimestamp(start, dt_timezone.utc),
+            'end_time': datetime.fromtimestamp(end, dt_timezone.utc),
+            # Manually added record, data not available
+            'len_adjust': None if len_adjust == -1.0 else int(len_adjust),
+            'actigraphy': samples
+        })
+
+    return sleep_records
+
+
+# Movement-based quality of the nights within a time period, averaged
+def analyze_sleep_quality(sleep_records, time_period=7, now=None):
+    end_time = now or datetime.now(timezone('UTC'))
+    start_time = end_time - timedelta(days=time_period)
+    nights = [record for record in sleep_records
+              if start_time <= record['start_time'] < end_time and len(record.get('actigraphy', ()))]
+    if not nights:
+        return None
+
+    metrics = analyze_quality(
+        [record['actigraphy'] for record in nights],
+        [(record['end_time'] - record['start_time']).total_seconds() / 60 for record in nights]
+    )
+    quality = {name: float(np.nanmean(values)) for name, values in metrics.items()}
+    quality['nights'] = len(nights)
+    return quality
+
+
+def generate_quality_report(quality, time_period=7):
+    report = "=-=-=-=-=  Sleep Quality Stats  =-=-=-=-=\n"
+    if quality is None:
+        return report + f"no tracked nights with movement data in the last {time_period}d\n"
+
+    longest_hours, longest_minutes = divmod(int(quality['longest_sleep_minutes']), 60)
+    report += f"--=--=--=    {time_period}d ({quality['nights']} nights)    =--=--=--\n"
+    report += f"sleep efficiency: {quality['sleep_efficiency']:.1f}%\n"
+    report += f"awakenings per hour: {quality['fragmentation_index']:.2f}\n"
+    report += f"avg longest stretch: {longest_hours}h {longest_minutes}m\n"
+    report += f"avg cycles: {quality['estimated_cycles']:.1f}\n"
+    return report
 
-        while True:
-            try:
-                header = next(csv_reader)
-                values = next(csv_reader)
-                sleep_record = parse_sleep_record(values)
-                sleep_records.append(sleep_record)
-            except StopIteration:
-                break
+
+def process_sleep_data(csv_file):
+    sleep_records = load_sleep_records(csv_file)
 
     analysis_results = analyze_sleep_data(sleep_records)
     report = generate_report(analysis_results)
+    report += "\n" + generate_quality_report(analyze_sleep_quality(sleep_records))
 
     # Send the report to Discord
     send_discord_message(report)
 
 
+def report_from_store(path, user_id=users.DEFAULT_USER, time_periods=(1, 3, 7), now=None):
+    """
+    Builds the same report from a SQLite file filled by
+    `import_to_db.py --sqlite`, without the export: the window stats are one
+    query, only the last week's records are read for the quality stats, and
+    the trends come from the running stats kept while importing.
+    """
+    end_time = now or datetime.now(timezone('UTC'))
+    # Opening a mistyped path would quietly create an empty database and
+    # report nothing
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"No such SQLite file: {path}")
+    # Files from older versions get their missing tables and stats here
+    sqlite_store.setup(path)
+    with sqlite_store.connect(path) as conn:
+        stats = sqlite_store.fetch_window_stats(conn, time_periods, end_time, user_id)
+        recent = sqlite_store.fetch_records(conn, end_time - timedelta(days=7), end_time, user_id)
+        trends = online_stats.summary(sqlite_store.load_online_stats(conn, user_id), end_time)
+
+    analysis_results = {
+        period: {
+            'sleep_ratio': values['sleep_ratio'],
+            'awake_ratio': values['awake_ratio'],
+            'total_sleep_duration': timedelta(seconds=values['sleep_seconds'])
+        }
+        for period, values in stats.items()
+    }
+    report = generate_report(analysis_results)
+    report += "\n" + generate_quality_report(analyze_sleep_quality(recent, now=end_time))
+    if trends is not None:
+        report += "\n=-=-=-=-=  Sleep Trends  =-=-=-=-=\n" + online_stats.format_summary(trends)['value']
+    return report
+
+
 def extract_export_zip(zip_file):
     """
     Extracts the contents of the backup export zip file from Sleep As Android
@@ -204,6 +340,22 @@ def extract_export_zip(zip_file):
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sleep report from sleep-export.zip, or from a local database")
+    parser.add_argument('--sqlite', metavar='PATH',
+                        help="report from this SQLite file (see import_to_db.py --sqlite) instead of the export")
+    parser.add_argument('--user', default=users.DEFAULT_USER, help="whose records to report on (with --sqlite)")
+    parser.add_argument('--windows', default='1,3,7', help="report windows in days, comma separated (with --sqlite)")
+    args = parser.parse_args()
+
     load_dotenv()
-    extract_export_zip("sleep-export.zip") # todo: script should exit here if extract fails for some reason lol
-    process_sleep_data('sleep-export/sleep-export.csv')
+    if args.sqlite:
+        windows = [int(days) for days in args.windows.split(',')]
+        try:
+            report = report_from_store(args.sqlite, args.user, windows)
+        except FileNotFoundError as e:
+            parser.error(str(e))
+        print(report)
+        send_discord_message(report)
+    else:
+        extract_export_zip("sleep-export.zip") # todo: script should exit here if extract fails for some reason lol
+        process_sleep_data('sleep-export/sleep-export.csv')
@@ -0,0 +1,49 @@
+# Compares the per-record dict parser in import_to_db.py with the columnar
+# NumPy loader on a synthetic export. Both parse the actigraphy too, as the
+# import pipeline does (process_sleep_data / process_sleep_data_columnar).
+#
+# Usage: python -m benchmarks.bench_parse --years 10
+
+import argparse
+import io
+import time
+
+import actigraphy
+import import_to_db
+import sleep_columns
+from benchmarks import synthetic
+
+
+def best_of(repeat, function, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main(years=10, repeat=3):
+    csv_text = synthetic.generate_csv(years)
+    print(f"Synthetic export: {years} years, {len(csv_text) / 1024 / 1024:.1f} MiB of CSV")
+    pairs = list(import_to_db.iter_csv_rows(io.StringIO(csv_text)))
+
+    runs = [
+        ("import_to_db dict path", lambda: import_to_db.process_sleep_data(io.StringIO(csv_text))),
+        ("columnar loader", lambda: sleep_columns.load_sleep_columns(io.StringIO(csv_text), with_actigraphy=True)),
+        ("columnar loader + iter_records", lambda: import_to_db.process_sleep_data_columnar(io.StringIO(csv_text))),
+        ("actigraphy alone", lambda: [actigraphy.parse_actigraphy(header, values) for header, values in pairs]),
+    ]
+
+    for name, run in runs:
+        elapsed, result = best_of(repeat, run)
+        count = len(result['id']) if isinstance(result, dict) else len(result)
+        print(f"{name:32s} {elapsed * 1000:8.1f}ms  {count / elapsed:10.0f} records/sec")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the dict and columnar export parsers")
+    parser.add_argument('--years', type=float, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    main(args.years, args.repeat)
@@ -0,0 +1,37 @@
+# Times the sleep quality engine over a batch of nights of synthetic
+# actigraphy (a year by default; the goal is well under a second).
+#
+# Usage: python -m benchmarks.bench_quality --years 1
+
+import argparse
+import io
+import time
+
+import sleep_columns
+import sleep_quality
+from benchmarks import synthetic
+
+
+def main(years=1, repeat=5):
+    columns = sleep_columns.load_sleep_columns(io.StringIO(synthetic.generate_csv(years)), with_actigraphy=True)
+    series = columns['actigraphy']
+    durations = (columns['end'] - columns['start']) / 60
+    samples = sum(len(night) for night in series)
+    print(f"{len(series)} nights, {samples} actigraphy samples")
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sleep_quality.analyze_quality(series, durations)
+        timings.append(time.perf_counter() - start)
+
+    best = min(timings)
+    print(f"analyze_quality: {best * 1000:.1f}ms ({len(series) / best:.0f} nights/sec)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the sleep quality engine")
+    parser.add_argument('--years', type=float, default=1)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    main(args.years, args.repeat)
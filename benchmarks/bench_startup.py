@@ -0,0 +1,83 @@
+# Cold start of the upload server: starts python http_server.py the way the
+# container does and measures, from process start,
+#
+#   first 200     GET /sleep-start answered (the server is listening)
+#   ready         GET /stats answered, i.e. the import pipeline is imported
+#                 and the database pool is up (needs Postgres, see the README)
+#
+# The median of --repeat starts is reported, so changes that add import-time
+# cost before the server binds show up as a higher "first 200".
+#
+# Usage: python -m benchmarks.bench_startup --repeat 5 [--python .venv/bin/python]
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+TIMEOUT = 60
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_200(url, deadline):
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter()
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.005)
+    raise TimeoutError(f"No 200 from {url} within {TIMEOUT}s")
+
+
+def measure(python, with_db):
+    port = free_port()
+    env = dict(os.environ, PORT=str(port), DISCORD_WEBHOOK='', UPLOAD_TOKENS='')
+    env.setdefault('DB_NAME', 'sleep_bench')
+    base = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    server = subprocess.Popen([python, 'http_server.py'], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = start + TIMEOUT
+        first = wait_for_200(base + '/sleep-start', deadline) - start
+        ready = wait_for_200(base + '/stats', deadline) - start if with_db else None
+    finally:
+        server.terminate()
+        server.wait()
+    return first, ready
+
+
+def main(repeat=5, python=sys.executable, with_db=True):
+    firsts, readies = [], []
+    for run in range(repeat):
+        first, ready = measure(python, with_db)
+        firsts.append(first)
+        print(f"run {run + 1}: first 200 {first * 1000:7.1f}ms" +
+              (f", ready {ready * 1000:7.1f}ms" if ready is not None else ""))
+        if ready is not None:
+            readies.append(ready)
+
+    print(f"median first 200 {statistics.median(firsts) * 1000:.1f}ms")
+    if readies:
+        print(f"median ready     {statistics.median(readies) * 1000:.1f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time from starting the upload server to its first 200")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--python', default=sys.executable, help="interpreter to start the server with")
+    parser.add_argument('--no-db', action='store_true', help="only time /sleep-start, not the pipeline warm-up")
+    args = parser.parse_args()
+    main(args.repeat, args.python, with_db=not args.no_db)
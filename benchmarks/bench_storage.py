@@ -0,0 +1,92 @@
+# Compares the two storage backends on synthetic exports:
+#
+#   ingest   import_to_database of the whole parsed export into empty tables
+#   report   window stats (1,3,7,30,365 days), 30 daily rows and the least
+#            sleep nights, the queries behind /stats and analysis.py --sqlite
+#
+# Postgres uses the usual DB_* settings with DB_NAME defaulting to sleep_bench
+# (emptied between runs, see the README); SQLite a temporary file.
+#
+# Usage: python -m benchmarks.bench_storage --years 1,10,50 [--no-postgres]
+
+import os
+
+# Before import_to_db reads its settings, as in benchmarks.run
+os.environ.setdefault('DB_NAME', 'sleep_bench')
+os.environ['DISCORD_WEBHOOK'] = ''
+
+import argparse
+import asyncio
+import tempfile
+
+import import_to_db
+import sleep_stats
+import sqlite_store
+from benchmarks import synthetic
+from benchmarks.run import ANALYSIS_NOW, best_of, best_of_async, quiet, reset_database
+
+WINDOWS = (1, 3, 7, 30, 365)
+
+
+async def postgres_report(pool):
+    await sleep_stats.fetch_window_stats(pool, WINDOWS, ANALYSIS_NOW)
+    await sleep_stats.fetch_daily(pool, 30, ANALYSIS_NOW)
+    await sleep_stats.fetch_least_sleep_nights(pool, WINDOWS, ANALYSIS_NOW)
+
+
+def sqlite_report(path):
+    with sqlite_store.connect(path) as conn:
+        sqlite_store.fetch_window_stats(conn, WINDOWS, ANALYSIS_NOW)
+        sqlite_store.fetch_daily(conn, 30, ANALYSIS_NOW)
+        sqlite_store.fetch_least_sleep_nights(conn, WINDOWS, ANALYSIS_NOW)
+
+
+async def bench_postgres(records, repeat):
+    import_to_db.DB_BACKEND = 'postgres'
+    with quiet():
+        pool = await import_to_db.create_pool()
+    try:
+        ingest, _ = await best_of_async(repeat, import_to_db.import_to_database, records, True, pool,
+                                        before=lambda: reset_database(pool))
+        report, _ = await best_of_async(repeat, postgres_report, pool)
+    finally:
+        await pool.close()
+    return ingest, report
+
+
+async def bench_sqlite(records, repeat):
+    import_to_db.DB_BACKEND = 'sqlite'
+    with tempfile.TemporaryDirectory() as directory:
+        sqlite_store.SQLITE_PATH = os.path.join(directory, 'bench.db')
+
+        async def reset():
+            with quiet():
+                sqlite_store.setup()
+            with sqlite_store.connect() as conn:
+                conn.execute("DELETE FROM sleep_records")
+                conn.execute("DELETE FROM sleep_actigraphy")
+                conn.execute("DELETE FROM sleep_online_stats")
+
+        ingest, _ = await best_of_async(repeat, import_to_db.import_to_database, records, before=reset)
+        report, _ = best_of(repeat, sqlite_report, sqlite_store.SQLITE_PATH)
+    return ingest, report
+
+
+def main(years_list, repeat=3, with_postgres=True):
+    backends = [('sqlite', bench_sqlite)] + ([('postgres', bench_postgres)] if with_postgres else [])
+    for years in years_list:
+        _, records = best_of(1, import_to_db.parse_zip_data, synthetic.generate_zip(years))
+        print(f"{years:g} years, {len(records)} records")
+        for name, bench in backends:
+            ingest, report = asyncio.run(bench(records, repeat))
+            print(f"  {name:9s} ingest {ingest * 1000:9.1f}ms ({len(records) / ingest:8.0f} records/sec)"
+                  f"   report {report * 1000:7.2f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare ingest and report latency of the storage backends")
+    parser.add_argument('--years', default='1,10', help="export sizes in years, comma separated")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per measurement, the best one is reported")
+    parser.add_argument('--no-postgres', action='store_true', help="only benchmark SQLite")
+    args = parser.parse_args()
+    main([float(years) for years in args.years.split(',')], args.repeat, with_postgres=not args.no_postgres)
@@ -0,0 +1,73 @@
+# Per-record cost of turning an export's wall-clock times into instants:
+# a pytz.timezone() lookup + localize per record (what both parsers did
+# before) against the tzcache resolver, import_to_db.parse_sleep_record on
+# top, and the columnar loader's offsets (sleep_columns.utc_offsets), which
+# come from the same resolver.
+#
+# Usage: python -m benchmarks.bench_tz --years 10
+
+import argparse
+import io
+import time
+from datetime import datetime
+
+from pytz import timezone
+
+import import_to_db
+import sleep_columns
+import tzcache
+from benchmarks import synthetic
+
+
+def pytz_localize(rows):
+    for tz_name, local in rows:
+        timezone(tz_name).localize(local)
+
+
+def tzcache_localize(rows):
+    for tz_name, local in rows:
+        tzcache.localize(local, tz_name)
+
+
+def columnar_offsets(rows):
+    tz_names, tz_codes = sleep_columns.categorize([row['Tz'] for row in rows])
+    local = sleep_columns.parse_local_times([row['To'] for row in rows])
+    for code, tz_name in enumerate(tz_names):
+        sleep_columns.utc_offsets(tz_name, local[tz_codes == code])
+
+
+def per_record(repeat, function, items):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(items)
+        timings.append(time.perf_counter() - start)
+    return min(timings) / len(items) * 1e6
+
+
+def main(years=10, repeat=3):
+    pairs = list(import_to_db.iter_csv_rows(io.StringIO(synthetic.generate_csv(years))))
+    rows = [dict(zip(header, values)) for header, values in pairs]
+    local_times = [(row['Tz'], datetime.strptime(row['To'], '%d. %m. %Y %H:%M')) for row in rows]
+    print(f"{len(rows)} records, {len({row['Tz'] for row in rows})} zones")
+
+    tzcache.utc_offset_seconds.cache_clear()
+    runs = [
+        ("pytz timezone() + localize", pytz_localize, local_times),
+        ("tzcache.localize (cold)", tzcache_localize, local_times),
+        ("tzcache.localize (warm)", tzcache_localize, local_times),
+        ("import_to_db.parse_sleep_record", lambda items: [import_to_db.parse_sleep_record(row) for row in items], rows),
+        ("sleep_columns.utc_offsets (warm)", columnar_offsets, rows),
+    ]
+    for name, function, items in runs:
+        # The cold run must really be cold, so it only gets one go
+        microseconds = per_record(1 if 'cold' in name else repeat, function, items)
+        print(f"{name:34s} {microseconds:8.2f}us/record")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark timezone resolution in the record parsers")
+    parser.add_argument('--years', type=float, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    main(args.years, args.repeat)
@@ -0,0 +1,74 @@
+# Checks that receiving an upload keeps memory flat as the upload grows:
+# streams bodies of increasing size through upload_jobs.receive_upload on a
+# local aiohttp server and reports the peak RSS after each one. With
+# --compare-read it finishes with the old request.read() path for contrast
+# (run last, since peak RSS never goes back down).
+#
+# Usage: python -m benchmarks.bench_upload_memory --sizes 16,64,256
+
+import argparse
+import asyncio
+import os
+import resource
+
+import aiohttp
+from aiohttp import web
+
+import upload_jobs
+
+CHUNK = os.urandom(1024 * 1024)
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def body(megabytes):
+    # Generated on the fly so the client side never holds the whole upload
+    for _ in range(megabytes):
+        yield CHUNK
+
+
+async def handle_stream(request):
+    data, size, digest = await upload_jobs.receive_upload(request.content)
+    upload_jobs.discard_upload(data)
+    return web.json_response({"size": size, "spooled": isinstance(data, str)})
+
+
+async def handle_read(request):
+    data = await request.read()
+    return web.json_response({"size": len(data), "spooled": False})
+
+
+async def main(sizes, compare_read=False):
+    app = web.Application(client_max_size=upload_jobs.UPLOAD_MAX_BYTES)
+    app.router.add_post('/stream', handle_stream)
+    app.router.add_post('/read', handle_read)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    base = f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+    print(f"Memory limit {upload_jobs.UPLOAD_MEMORY_LIMIT / 1024**2:.0f}MB, baseline peak RSS {peak_rss_mb():.0f}MB")
+    paths = [('/stream', size) for size in sizes]
+    if compare_read:
+        paths.append(('/read', sizes[-1]))
+    try:
+        async with aiohttp.ClientSession() as session:
+            for path, size in paths:
+                async with session.post(base + path, data=body(size)) as response:
+                    result = await response.json()
+                print(f"{path:8} {size:5}MB upload{' (spooled)' if result['spooled'] else ''}: "
+                      f"peak RSS {peak_rss_mb():.0f}MB")
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Peak memory of receiving uploads of growing size")
+    parser.add_argument('--sizes', default='16,64,256', help="upload sizes in MB")
+    parser.add_argument('--compare-read', action='store_true',
+                        help="also receive the largest size with request.read()")
+    args = parser.parse_args()
+    asyncio.run(main([int(size) for size in args.sizes.split(',')], args.compare_read))
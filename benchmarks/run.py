@@ -0,0 +1,218 @@
+# Benchmark suite: times each stage of the pipeline separately on synthetic
+# exports of a few sizes and writes the results as JSON, so runs can be
+# compared across commits.
+#
+#   extract       streaming the CSV out of the ZIP (open_sleep_csv)
+#   parse         import_to_db.parse_zip_data, dict and columnar parsers
+#   import        import_to_database into empty tables
+#   analysis      analysis.load_sleep_records + analyze_sleep_data
+#   upload        POST /upload to the server app until its job is done
+#   export_*      GET /export of everything just uploaded, per format
+#
+# The import and upload stages need Postgres. It uses the usual DB_* settings
+# but defaults DB_NAME to sleep_bench, whose tables are emptied between runs.
+# See the README for starting a local Postgres container.
+#
+# Usage: python -m benchmarks.run --years 1,10,50 --output benchmark-results.json
+
+import os
+
+# Before import_to_db reads its settings: never benchmark against the real
+# database, and never post to Discord
+os.environ.setdefault('DB_NAME', 'sleep_bench')
+os.environ['DISCORD_WEBHOOK'] = ''
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import analysis
+import import_to_db
+import sleep_export
+from benchmarks import synthetic
+
+# The synthetic exports end on 2024-10-01, so the report windows are taken there
+ANALYSIS_NOW = datetime(2024, 10, 1, tzinfo=timezone.utc)
+
+
+@contextlib.contextmanager
+def quiet():
+    # The pipeline reports progress with print; keep it out of the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def best_of(repeat, function, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with quiet():
+            result = function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+async def best_of_async(repeat, function, *args, before=None):
+    timings = []
+    for _ in range(repeat):
+        if before is not None:
+            await before()
+        start = time.perf_counter()
+        with quiet():
+            result = await function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def read_through(zip_data):
+    size = 0
+    with import_to_db.open_sleep_csv(zip_data) as csv_file:
+        while block := csv_file.read(1024 * 1024):
+            size += len(block)
+    return size
+
+
+async def reset_database(pool, module=import_to_db):
+    await pool.execute("TRUNCATE sleep_records, sleep_daily, upload_digests, sleep_online_stats CASCADE")
+    module._high_water_marks.clear()
+
+
+async def upload(client, zip_data):
+    response = await client.post('/upload', data=zip_data, headers={'Content-Type': 'application/zip'})
+    job = await response.json()
+    while True:
+        status = await (await client.get(job['status_url'])).json()
+        if status['status'] in ('done', 'failed'):
+            return status
+        await asyncio.sleep(0.01)
+
+
+async def export(client, export_format):
+    size = 0
+    response = await client.get(f'/export?format={export_format}')
+    async for chunk in response.content.iter_chunked(1024 * 1024):
+        size += len(chunk)
+    if response.status != 200:
+        raise RuntimeError(f"Export failed with {response.status}")
+    return size
+
+
+async def run_database_stages(exports, repeat, with_upload):
+    results = []
+    with quiet():
+        pool = await import_to_db.create_pool()
+    try:
+        for years, zip_data, records, count in exports:
+            elapsed, _ = await best_of_async(
+                repeat, import_to_db.import_to_database, records, True, pool, before=lambda: reset_database(pool)
+            )
+            results.append(result(years, 'import', elapsed, count))
+    finally:
+        await pool.close()
+
+    if with_upload:
+        results += await run_upload_stage(exports, repeat)
+    return results
+
+
+async def run_upload_stage(exports, repeat):
+    from aiohttp.test_utils import TestClient, TestServer
+    with quiet():
+        import http_server
+
+    results = []
+    async with contextlib.AsyncExitStack() as stack:
+        with quiet():
+            client = await stack.enter_async_context(TestClient(TestServer(http_server.app)))
+        app = client.server.app
+        with quiet():
+            pipeline = await http_server.pipeline_ready(app)
+
+        async def before():
+            await reset_database(pipeline['db_pool'], http_server.import_to_db)
+            pipeline['digest_cache'].entries.clear()
+
+        for years, zip_data, records, count in exports:
+            elapsed, status = await best_of_async(repeat, upload, client, zip_data, before=before)
+            if status['status'] != 'done':
+                raise RuntimeError(f"Upload failed: {status['error']}")
+            results.append(result(years, 'upload', elapsed, count, timings=status['timings']))
+
+            for export_format in sleep_export.available_formats():
+                elapsed, size = await best_of_async(repeat, export, client, export_format)
+                results.append(result(years, f'export_{export_format}', elapsed, count, bytes=size))
+    return results
+
+
+def result(years, stage, seconds, records, **extra):
+    print(f"{years:5g}y {stage:18s} {seconds * 1000:10.1f}ms  {records / seconds:10.0f} records/sec")
+    return dict(years=years, stage=stage, seconds=round(seconds, 6), records=records,
+                records_per_sec=round(records / seconds, 1), **extra)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(years_list, repeat=3, output='benchmark-results.json', with_db=True, with_upload=True):
+    results = []
+    exports = []
+    for years in years_list:
+        csv_text = synthetic.generate_csv(years)
+        zip_data = synthetic.generate_zip(years)
+        print(f"Synthetic export: {years} years, {len(csv_text) / 1024**2:.1f} MiB of CSV, "
+              f"{len(zip_data) / 1024**2:.1f} MiB zipped")
+
+        elapsed, _ = best_of(repeat, read_through, zip_data)
+        _, records = best_of(1, import_to_db.parse_zip_data, zip_data, None, False)
+        count = len(records)
+        results.append(result(years, 'extract', elapsed, count, bytes=len(csv_text)))
+
+        elapsed, _ = best_of(repeat, import_to_db.parse_zip_data, zip_data, None, False)
+        results.append(result(years, 'parse', elapsed, count))
+        elapsed, _ = best_of(repeat, import_to_db.parse_zip_data, zip_data, None, True)
+        results.append(result(years, 'parse_columnar', elapsed, count))
+
+        elapsed, sleep_records = best_of(repeat, lambda: analysis.load_sleep_records(io.StringIO(csv_text)))
+        results.append(result(years, 'analysis_load', elapsed, count))
+        elapsed, _ = best_of(repeat, analysis.analyze_sleep_data, sleep_records, (1, 3, 7), ANALYSIS_NOW)
+        results.append(result(years, 'analysis', elapsed, count))
+
+        exports.append((years, zip_data, records, count))
+
+    if with_db:
+        results += asyncio.run(run_database_stages(exports, repeat, with_upload))
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "results": results,
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {output}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time each pipeline stage on synthetic exports")
+    parser.add_argument('--years', default='1,10', help="export sizes in years, comma separated (up to 50)")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per stage, the best one is reported")
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--no-db', action='store_true', help="skip the stages that need Postgres")
+    parser.add_argument('--no-upload', action='store_true', help="skip the end-to-end /upload stage")
+    args = parser.parse_args()
+    main([float(years) for years in args.years.split(',')], args.repeat, args.output,
+         with_db=not args.no_db, with_upload=not args.no_upload)
@@ -0,0 +1,133 @@
+# =-=-=-=-==-=-=-=-=-=-=-=-=
+# Synthetic Sleep as Android Export
+# =-=-=-=-==-=-=-=-=-=-=-=-=
+#
+# Generates exports in the same alternating header/value CSV layout the app
+# writes: the fixed Id/Tz/From/To/.../Geo/Comment columns, then one column per
+# actigraphy sample labelled with its wall-clock time, then one "Event" column
+# per event. Mostly nights at home in one zone, with some travel, naps and
+# manually added records mixed in. Seeded, so runs are comparable.
+#
+# Usage: python -m benchmarks.synthetic --years 10 --output sleep-export.zip
+
+import argparse
+import csv
+import io
+import random
+import zipfile
+from datetime import datetime, timedelta
+
+from pytz import timezone
+
+HEADER = ['Id', 'Tz', 'From', 'To', 'Sched', 'Hours', 'Rating', 'Comment', 'Framerate',
+          'Snore', 'Noise', 'Cycles', 'DeepSleep', 'LenAdjust', 'Geo']
+TIME_FORMAT = '%d. %m. %Y %H:%M'
+HOME = ('Europe/Budapest', 'u2mw1q')
+TRAVEL = [('Europe/London', 'gcpvj0'), ('America/New_York', 'dr5reg'), ('Asia/Tokyo', 'xn76ur')]
+# Minutes between actigraphy samples in the export
+SAMPLE_MINUTES = 5
+
+
+def generate_records(years=10, seed=0, end=None):
+    # Yields (header, values) row pairs, newest record last
+    rng = random.Random(seed)
+    end = end or datetime(2024, 10, 1)
+    day = end - timedelta(days=int(years * 365.25))
+    tz_name, geo = HOME
+    travel_days = 0
+
+    while day < end:
+        if travel_days == 0 and rng.random() < 0.02:
+            tz_name, geo = rng.choice(TRAVEL)
+            travel_days = rng.randint(2, 10)
+        elif travel_days > 0:
+            travel_days -= 1
+            if travel_days == 0:
+                tz_name, geo = HOME
+
+        yield make_record(rng, tz_name, geo, day + timedelta(hours=22, minutes=rng.randint(0, 150)),
+                          rng.uniform(5.5, 9.0), manual=rng.random() < 0.03)
+        if rng.random() < 0.05:
+            yield make_record(rng, tz_name, geo, day + timedelta(hours=14, minutes=rng.randint(0, 120)),
+                              rng.uniform(0.3, 1.5), manual=False)
+        day += timedelta(days=1)
+
+
+def make_record(rng, tz_name, geo, local_start, hours, manual):
+    tz = timezone(tz_name)
+    start = tz.normalize(tz.localize(local_start))
+    end = tz.normalize(start + timedelta(hours=hours))
+    start_ms = int(start.timestamp() * 1000)
+
+    if manual:
+        cycles, deep_sleep, len_adjust = -1, -1.0, -1.0
+        comment = 'Manually added'
+    else:
+        cycles = max(1, int(hours / 1.5))
+        deep_sleep = round(rng.uniform(0.2, 0.6), 3)
+        len_adjust = -float(rng.randint(0, 45))
+        comment = rng.choice(['', '', '', '#home', '#caffeine', '#stress #work'])
+
+    header = list(HEADER)
+    values = [
+        str(start_ms), tz_name, start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT),
+        end.strftime(TIME_FORMAT), f"{hours:.3f}", '0.0', comment, '10000',
+        '-1', '-1.0', str(cycles), str(deep_sleep), str(len_adjust), geo
+    ]
+
+    if not manual:
+        samples = int(hours * 60 / SAMPLE_MINUTES)
+        for index in range(samples):
+            sample_time = start + timedelta(minutes=index * SAMPLE_MINUTES)
+            header.append(tz.normalize(sample_time).strftime('%H:%M'))
+            # Calm stretches with bursts of movement roughly every cycle
+            phase = (index * SAMPLE_MINUTES) % 90
+            movement = rng.expovariate(4.0) + (rng.uniform(0.5, 3.0) if phase > 75 else 0.0)
+            values.append(f"{movement:.4f}")
+
+        event_time = start_ms
+        for stage in ['LIGHT_START', 'DEEP_START', 'DEEP_END', 'REM_START', 'REM_END'] * cycles:
+            event_time += rng.randint(5, 30) * 60 * 1000
+            header.append('Event')
+            values.append(f"{stage}-{event_time}")
+        header.append('Event')
+        values.append(f"HR-{start_ms + 600000}-{rng.uniform(48, 70):.1f}")
+
+    return header, values
+
+
+def write_csv(rows, file):
+    writer = csv.writer(file, quoting=csv.QUOTE_ALL, lineterminator='\n')
+    for header, values in rows:
+        writer.writerow(header)
+        writer.writerow(values)
+
+
+def generate_csv(years=10, seed=0):
+    buffer = io.StringIO()
+    write_csv(generate_records(years, seed), buffer)
+    return buffer.getvalue()
+
+
+def generate_zip(years=10, seed=0):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('Sleep as Android Data/sleep-export.csv', generate_csv(years, seed))
+    return buffer.getvalue()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write a synthetic Sleep as Android export")
+    parser.add_argument('--years', type=float, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='sleep-export.zip')
+    args = parser.parse_args()
+
+    if args.output.endswith('.zip'):
+        data = generate_zip(args.years, args.seed)
+        with open(args.output, 'wb') as f:
+            f.write(data)
+    else:
+        with open(args.output, 'w', encoding='utf-8', newline='') as f:
+            write_csv(generate_records(args.years, args.seed), f)
+    print(f"Wrote {args.years} years of synthetic sleep data to {args.output}")
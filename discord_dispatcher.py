@@ -0,0 +1,139 @@
+# =-=-=-=-==-=-=-=-=-=-=
+# Discord Notifications
+# =-=-=-=-==-=-=-=-=-=-=
+#
+# Background dispatcher for the Discord webhook. Handlers queue messages and
+# return straight away; one long-lived task sends them in order over a single
+# aiohttp session.
+#
+# - embeds are split so each message stays within Discord's limits
+#   (25 fields and 6000 characters per embed)
+# - 429 responses are retried after the Retry-After the webhook asks for,
+#   other failures back off exponentially a few times before giving up
+
+import asyncio
+
+import aiohttp
+
+import metrics
+
+EMBED_COLOR = 0x8A2BE2
+MAX_FIELDS_PER_EMBED = 25
+MAX_EMBED_CHARS = 6000
+MAX_RETRIES = 5
+
+
+def field_size(field):
+    return len(field['name']) + len(field['value'])
+
+
+def build_payloads(message, fields=None, title="Sleep"):
+    # One webhook payload per embed, each within the field/character limits.
+    # Follow-up embeds get a "(part n/m)" title so they read as one message.
+    chunks = []
+    current = []
+    current_size = len(title) + len(message)
+    for field in fields or []:
+        if current and (len(current) == MAX_FIELDS_PER_EMBED or current_size + field_size(field) > MAX_EMBED_CHARS):
+            chunks.append(current)
+            current = []
+            current_size = len(title) + 16
+        current.append(field)
+        current_size += field_size(field)
+    chunks.append(current)
+
+    payloads = []
+    for index, chunk in enumerate(chunks):
+        embed = {
+            "title": title if len(chunks) == 1 else f"{title} (part {index + 1}/{len(chunks)})",
+            "description": message if index == 0 else "",
+            "color": EMBED_COLOR,
+            "fields": chunk
+        }
+        payloads.append({"embeds": [embed]})
+    return payloads
+
+
+class DiscordDispatcher:
+    def __init__(self, webhook, max_retries=MAX_RETRIES):
+        self.webhook = webhook
+        self.max_retries = max_retries
+        self.queue = asyncio.Queue()
+        self.session = None
+        self.task = None
+
+    async def start(self):
+        self.session = aiohttp.ClientSession()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self, timeout=10):
+        # Give queued messages a chance to go out before shutting down
+        if self.task is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                print(f"Dropping {self.queue.qsize()} queued Discord messages on shutdown")
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.session is not None:
+            await self.session.close()
+
+    def notify(self, message, fields=None):
+        if not self.webhook:
+            print("Discord notification not sent: DISCORD_WEBHOOK is not set")
+            return
+        for payload in build_payloads(message, fields):
+            self.queue.put_nowait(payload)
+
+    async def run(self):
+        while True:
+            payload = await self.queue.get()
+            try:
+                with metrics.span('discord'):
+                    sent = await self.send(payload)
+                metrics.inc('discord_messages', outcome='sent' if sent else 'failed')
+            except Exception as e:
+                print(f"Failed to send Discord notification: {e}")
+                metrics.inc('discord_messages', outcome='failed')
+            finally:
+                self.queue.task_done()
+
+    async def send(self, payload):
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.session.post(self.webhook, json=payload) as response:
+                    if response.status in (200, 204):
+                        print("Discord notification sent successfully")
+                        return True
+                    if response.status == 429:
+                        delay = await self.retry_after(response)
+                        metrics.inc('discord_messages', outcome='rate_limited')
+                        print(f"Discord rate limited, retrying in {delay:.2f}s")
+                    elif response.status >= 500:
+                        delay = 2 ** attempt
+                        print(f"Discord returned {response.status}, retrying in {delay}s")
+                    else:
+                        print(f"Failed to send Discord notification. Status: {response.status}")
+                        return False
+            except aiohttp.ClientError as e:
+                delay = 2 ** attempt
+                print(f"Error sending Discord notification: {e}, retrying in {delay}s")
+            await asyncio.sleep(delay)
+
+        print(f"Giving up on Discord notification after {self.max_retries + 1} attempts")
+        return False
+
+    @staticmethod
+    async def retry_after(response):
+        # Discord sends Retry-After (seconds) and retry_after in the JSON body
+        header = response.headers.get('Retry-After')
+        if header:
+            return float(header)
+        try:
+            body = await response.json(content_type=None)
+            return float(body.get('retry_after', 1))
+        except (ValueError, TypeError, AttributeError, aiohttp.ContentTypeError):
+            return 1.0
@@ -1,50 +1,84 @@
 import os
 from dotenv import load_dotenv
-import aiohttp
 from aiohttp import web
 import asyncio
+import functools
 import importlib.util
+import sys
+import time
+import sleep_stats
+import sleep_export
+import location_stats
+import metrics
+import users
+from discord_dispatcher import DiscordDispatcher
+from upload_jobs import DigestCache, UploadJobs, UploadTooLarge, UPLOAD_MAX_BYTES, receive_upload, discard_upload
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 print("Starting HTTP POST Upload Server")
 
 load_dotenv()
 DISCORD_WEBHOOK = os.getenv('DISCORD_WEBHOOK')
 
-# Import the main function from import_to_db.py
-spec = importlib.util.spec_from_file_location("import_to_db", "import_to_db.py")
-import_to_db = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(import_to_db)
-print("Successfully imported import_to_db.py")
+# Extraction and CSV parsing run off the event loop in this pool
+# ("process" or "thread"), so a big upload doesn't stall other requests
+UPLOAD_EXECUTOR = os.getenv('UPLOAD_EXECUTOR', 'process')
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', '2'))
+# Uploads waiting in the job queue; further ones get a 503
+MAX_PENDING_UPLOADS = int(os.getenv('MAX_PENDING_UPLOADS', '4'))
+# Tasks taking jobs off the queue. Each user's uploads are still imported
+# one at a time in the order they arrived; more workers let different users'
+# uploads run in parallel.
+UPLOAD_JOB_WORKERS = int(os.getenv('UPLOAD_JOB_WORKERS', '2'))
+PORT = int(os.getenv('PORT', '9292'))
+
+# The import pipeline (import_to_db.py and through it asyncpg, patool, numpy
+# and the tz database) is loaded, and the database pool set up, in the
+# background once the server is listening, so /sleep-start answers right
+# after a (re)start. Handlers that need it wait for it with pipeline_ready(),
+# which returns app['pipeline'], the dict holding the pool and digest cache
+# (aiohttp doesn't want app itself changed once it is running).
+import_to_db = None
+
+def load_import_to_db():
+    global import_to_db
+    if import_to_db is None:
+        spec = importlib.util.spec_from_file_location("import_to_db", "import_to_db.py")
+        module = importlib.util.module_from_spec(spec)
+        # Registered so worker processes can unpickle references to its functions
+        sys.modules["import_to_db"] = module
+        spec.loader.exec_module(module)
+        import_to_db = module
+        print("Successfully imported import_to_db.py")
+    return import_to_db
 
 if not DISCORD_WEBHOOK or not isinstance(DISCORD_WEBHOOK, str):
     print("Error: DISCORD_WEBHOOK is not set or is not a string")
     DISCORD_WEBHOOK = None
 
-async def send_discord_notification(message, new_record_details=None):
-    if DISCORD_WEBHOOK:
-        async with aiohttp.ClientSession() as session:
-            embed = {
-                "title": "Sleep",
-                "description": message,
-                "color": 0x8A2BE2,
-                "fields": []
-            }
-            
-            if new_record_details:
-                embed["fields"] = new_record_details
-            
-            webhook_data = {"embeds": [embed]}
-            async with session.post(DISCORD_WEBHOOK, json=webhook_data) as response:
-                if response.status == 204:
-                    print("Discord notification sent successfully")
-                else:
-                    print(f"Failed to send Discord notification. Status: {response.status}")
-    else:
-        print("Discord notification not sent: DISCORD_WEBHOOK is not set")
+# Messages are queued and sent by a background task (see discord_dispatcher.py),
+# so handlers don't wait on the webhook
+discord = DiscordDispatcher(DISCORD_WEBHOOK)
+
+async def send_discord_notification(message, new_record_details=None, user_id=None):
+    if users.MULTI_USER and user_id:
+        message = f"[{user_id}] {message}"
+    discord.notify(message, new_record_details)
+
+def request_user(request):
+    # The user a request's token belongs to (see users.py), or None
+    return users.user_for_token(users.request_token(request.headers, request.query))
+
+def unauthorized():
+    return web.json_response({"error": "Missing or invalid token"}, status=401)
 
 async def handle_sleep_start(request):
+    # Doesn't need the import pipeline, so this works while it is still warming up
     print("Received sleep-start request")
-    await send_discord_notification("Sleep tracking started!")
+    user_id = request_user(request)
+    if user_id is None:
+        return unauthorized()
+    await send_discord_notification("Sleep tracking started!", user_id=user_id)
     return web.Response(text="Sleep tracking start recorded.")
 
 async def handle_upload(request):
@@ -54,39 +88,289 @@ async def handle_upload(request):
     if content_type != 'application/zip':
         print("Error: Invalid content type")
         return web.Response(text="Invalid content type. Please upload a ZIP file.", status=400)
-    
-    zip_data = await request.read()
-    print(f"Received ZIP data: {len(zip_data)} bytes")
-    
-    # Process the uploaded file
-    print("Processing sleep data")
-    success, new_records, new_record_details = await process_sleep_data(zip_data)
-    
-    if success:
-        print("Processing completed successfully")
-        if new_records > 0:
-            await send_discord_notification(f"New sleep data! {new_records} new records.", new_record_details)
-        else:
-            await send_discord_notification("Sleep tracking likely cancelled. No new sleep data found.")
-        return web.Response(text="ZIP file uploaded and processed successfully.")
+
+    user_id = request_user(request)
+    if user_id is None:
+        print("Error: Upload without a valid token")
+        return unauthorized()
+
+    if request.content_length is not None and request.content_length > UPLOAD_MAX_BYTES:
+        print(f"Error: Upload of {request.content_length} bytes is too large")
+        return web.Response(text=f"Upload is larger than {UPLOAD_MAX_BYTES} bytes.", status=413)
+
+    # Streamed in chunks; large uploads are spooled to a temp file rather than
+    # held in memory (see upload_jobs.receive_upload)
+    try:
+        zip_data, size, digest = await receive_upload(request.content)
+    except UploadTooLarge as e:
+        print(f"Error: {e}")
+        return web.Response(text=f"{e}.", status=413)
+    print(f"Received ZIP data: {size} bytes{' (spooled to disk)' if isinstance(zip_data, str) else ''}")
+    metrics.inc('bytes_received', size)
+
+    # ?full_rescan=1 re-parses the whole export instead of only records newer
+    # than the latest one already in the database, less HIGH_WATER_MARGIN_DAYS
+    # (useful for backfills, and records back-dated further than that)
+    full_rescan = request.query.get('full_rescan', '').lower() in ('1', 'true', 'yes')
+
+    try:
+        pipeline = await pipeline_ready(request.app)
+    except Exception:
+        discard_upload(zip_data)
+        return pipeline_unavailable()
+
+    # Exactly the same export as one already processed: nothing new in it
+    cached = None if full_rescan else await pipeline['digest_cache'].get(user_id, digest)
+    if cached is not None:
+        print(f"Upload {digest[:12]} from {user_id} was already processed ({cached['result']}), skipping")
+        discard_upload(zip_data)
+        metrics.inc('uploads', outcome='cached')
+        await send_discord_notification("Sleep tracking likely cancelled. No new sleep data found.", user_id=user_id)
+        return web.json_response({"status": "done", "duplicate": True, "cached": True, "result": cached['result']})
+
+    try:
+        job, duplicate = request.app['upload_jobs'].submit(user_id, zip_data, size, digest, full_rescan)
+    except asyncio.QueueFull:
+        print("Error: Upload queue is full")
+        discard_upload(zip_data)
+        metrics.inc('uploads', outcome='rejected')
+        return web.Response(text="Server is busy processing other uploads. Please retry later.", status=503)
+
+    status_url = f"/jobs/{job['id']}"
+    return web.json_response(
+        {"job_id": job['id'], "status": job['status'], "status_url": status_url, "duplicate": duplicate},
+        status=202, headers={"Location": status_url}
+    )
+
+async def process_upload_job(app, job, zip_data):
+    # Runs in an UploadJobs worker, see upload_jobs.py
+    with metrics.profile_if_slow(f"upload-{job['id']}"):
+        try:
+            result = await run_upload_job(app, job, zip_data)
+        except Exception:
+            metrics.inc('uploads', outcome='failed')
+            raise
+    metrics.inc('uploads', outcome='processed')
+    return result
+
+async def run_upload_job(app, job, zip_data):
+    pipeline = app['pipeline']
+    user_id = job['user_id']
+    print(f"Processing sleep data for job {job['id']} ({user_id})")
+    try:
+        success, new_records, new_record_details = await process_sleep_data(
+            zip_data, job['full_rescan'], pipeline['db_pool'], app['upload_executor'], progress=job, user_id=user_id
+        )
+        if not success:
+            raise RuntimeError(job['error'] or "Processing failed")
+    except Exception as e:
+        # A failed parse returns success=False, while the database stages
+        # (insert, rollup, online stats) raise; both get the same notification
+        print(f"Processing failed: {e}")
+        job['error'] = job['error'] or str(e)
+        job['stage'] = 'notify'
+        await send_discord_notification("Failed to process sleep data. Please check the logs.", user_id=user_id)
+        raise
+
+    job['stage'] = 'notify'
+    print("Processing completed successfully")
+    if new_records > 0:
+        await send_discord_notification(f"New sleep data! {new_records} new records.", new_record_details, user_id)
+        job['result'] = f"{new_records} new records"
     else:
-        print("Processing failed")
-        await send_discord_notification("Failed to process sleep data. Please check the logs.")
-        return web.Response(text="ZIP file uploaded, but processing failed.", status=500)
+        await send_discord_notification("Sleep tracking likely cancelled. No new sleep data found.", user_id=user_id)
+        job['result'] = "No new sleep data found"
+    await pipeline['digest_cache'].put(job)
+    return job['result']
+
+async def handle_job_status(request):
+    user_id = request_user(request)
+    if user_id is None:
+        return unauthorized()
+    job = request.app['upload_jobs'].get(request.match_info['job_id'], user_id)
+    if job is None:
+        return web.json_response({"error": "Unknown job"}, status=404)
+    return web.json_response(job)
 
-async def process_sleep_data(zip_data):
+async def process_sleep_data(zip_data, full_rescan=False, pool=None, executor=None, progress=None,
+                             user_id=users.DEFAULT_USER):
     print("Calling import_to_db.main function")
-    success, new_records, new_record_details = await import_to_db.main(zip_data)
+    success, new_records, new_record_details = await load_import_to_db().main(
+        zip_data, full_rescan=full_rescan, pool=pool, executor=executor, progress=progress, user_id=user_id
+    )
     print(f"import_to_db.main function returned: success={success}, new_records={new_records}")
     return success, new_records, new_record_details
 
+async def handle_metrics(request):
+    return web.Response(text=metrics.render(), content_type='text/plain')
+
+async def handle_stats(request):
+    user_id = request_user(request)
+    if user_id is None:
+        return unauthorized()
+    try:
+        windows = sleep_stats.parse_windows(request.query.get('windows'))
+    except ValueError as e:
+        return web.json_response({"error": f"Invalid windows: {e}"}, status=400)
+
+    try:
+        pipeline = await pipeline_ready(request.app)
+    except Exception:
+        return pipeline_unavailable()
+    pool = pipeline['db_pool']
+    stats = await sleep_stats.fetch_window_stats(pool, windows, user_id=user_id)
+    least_sleep = await sleep_stats.fetch_least_sleep_nights(pool, windows, user_id=user_id)
+    for days, values in stats.items():
+        values['least_sleep_night'] = least_sleep.get(days)
+    return web.json_response({str(days): values for days, values in stats.items()})
+
+async def handle_daily_stats(request):
+    user_id = request_user(request)
+    if user_id is None:
+        return unauthorized()
+    try:
+        days = sleep_stats.parse_windows(request.query.get('days'), default=(30,))[-1]
+    except ValueError as e:
+        return web.json_response({"error": f"Invalid days: {e}"}, status=400)
+
+    try:
+        pipeline = await pipeline_ready(request.app)
+    except Exception:
+        return pipeline_unavailable()
+    daily = await sleep_stats.fetch_daily(pipeline['db_pool'], days, user_id=user_id)
+    return web.json_response(daily)
+
+async def handle_location_stats(request):
+    # Sleep per place and home vs away, see location_stats.py
+    user_id = request_user(request)
+    if user_id is None:
+        return unauthorized()
+    try:
+        precision, years, home = location_stats.parse_location_query(request.query)
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400)
+
+    try:
+        pipeline = await pipeline_ready(request.app)
+    except Exception:
+        return pipeline_unavailable()
+    cells = await location_stats.get_cells(pipeline['db_pool'], user_id)
+    return web.json_response(location_stats.summarize(cells, precision, years, home))
+
+async def handle_export(request):
+    # Streams the caller's records as CSV, Arrow or Parquet, see sleep_export.py
+    user_id = request_user(request)
+    if user_id is None:
+        return unauthorized()
+    try:
+        export_format, time_from, time_to = sleep_export.parse_export_query(request.query)
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400)
+
+    try:
+        pipeline = await pipeline_ready(request.app)
+    except Exception:
+        return pipeline_unavailable()
+
+    content_type, extension = sleep_export.FORMATS[export_format]
+    response = web.StreamResponse(headers={
+        "Content-Type": content_type,
+        "Content-Disposition": f'attachment; filename="sleep-records-{user_id}.{extension}"',
+    })
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    await sleep_export.stream_export(pipeline['db_pool'], response.write, user_id, export_format, time_from, time_to)
+    await response.write_eof()
+    return response
+
+async def warm_pipeline(app):
+    # Imports the pipeline off the event loop, then sets up the schema and the
+    # connection pool once here instead of on every upload
+    start = time.perf_counter()
+    module = await asyncio.get_running_loop().run_in_executor(None, load_import_to_db)
+    pipeline = app['pipeline']
+    pipeline['db_pool'] = await module.create_pool()
+    pipeline['digest_cache'] = DigestCache(pipeline['db_pool'])
+    print(f"Import pipeline ready in {time.perf_counter() - start:.2f}s")
+
+async def pipeline_ready(app):
+    # Waits for warm_pipeline. If it failed (say Postgres wasn't up yet), the
+    # next caller starts it again rather than the server staying broken.
+    pipeline = app['pipeline']
+    if pipeline['task'].done() and pipeline['task'].exception() is not None:
+        launch_pipeline(app)
+    await asyncio.shield(pipeline['task'])
+    return pipeline
+
+def pipeline_unavailable():
+    return web.Response(text="Database is not available yet. Please retry later.", status=503)
+
+def launch_pipeline(app):
+    app['pipeline']['task'] = asyncio.create_task(warm_pipeline(app))
+    app['pipeline']['task'].add_done_callback(report_pipeline_failure)
+
+def report_pipeline_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Error: Could not start the import pipeline: {task.exception()}")
+
+async def start_pipeline(app):
+    # Not awaited: aiohttp only starts listening once every startup hook returned
+    app['pipeline'] = {}
+    launch_pipeline(app)
+
+async def stop_pipeline(app):
+    pipeline = app['pipeline']
+    if not pipeline['task'].done():
+        pipeline['task'].cancel()
+    if 'db_pool' in pipeline:
+        await pipeline['db_pool'].close()
+
+async def init_upload_executor(app):
+    if UPLOAD_EXECUTOR == 'thread':
+        app['upload_executor'] = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+    else:
+        app['upload_executor'] = ProcessPoolExecutor(max_workers=UPLOAD_WORKERS)
+    print(f"Upload parsing runs in a {UPLOAD_EXECUTOR} pool with {UPLOAD_WORKERS} workers")
+
+async def close_upload_executor(app):
+    app['upload_executor'].shutdown(wait=False, cancel_futures=True)
+
+async def start_upload_jobs(app):
+    handler = functools.partial(process_upload_job, app)
+    app['upload_jobs'] = UploadJobs(handler, max_queued=MAX_PENDING_UPLOADS, workers=UPLOAD_JOB_WORKERS)
+    await app['upload_jobs'].start()
+
+async def stop_upload_jobs(app):
+    await app['upload_jobs'].stop()
+
+async def start_discord_dispatcher(app):
+    await discord.start()
+
+async def stop_discord_dispatcher(app):
+    await discord.stop()
+
+# /upload streams its body and enforces UPLOAD_MAX_BYTES itself
 app = web.Application(client_max_size=1024**3)  # Set to 1GB
+app.on_startup.append(start_pipeline)
+app.on_startup.append(init_upload_executor)
+app.on_startup.append(start_discord_dispatcher)
+app.on_startup.append(start_upload_jobs)
+app.on_cleanup.append(stop_upload_jobs)
+app.on_cleanup.append(stop_pipeline)
+app.on_cleanup.append(close_upload_executor)
+app.on_cleanup.append(stop_discord_dispatcher)
 app.router.add_post('/upload', handle_upload)
+app.router.add_get('/jobs/{job_id}', handle_job_status)
 app.router.add_get('/sleep-start', handle_sleep_start)
+app.router.add_get('/stats', handle_stats)
+app.router.add_get('/stats/daily', handle_daily_stats)
+app.router.add_get('/stats/locations', handle_location_stats)
+app.router.add_get('/export', handle_export)
+app.router.add_get('/metrics', handle_metrics)
 
 if __name__ == '__main__':
-    print("Starting web server on http://0.0.0.0:9292")
-    web.run_app(app, host='0.0.0.0', port=9292)
+    print(f"Starting web server on http://0.0.0.0:{PORT}")
+    web.run_app(app, host='0.0.0.0', port=PORT)
 
 async def handle_sleep_start(request):
     print("Received sleep-start request")
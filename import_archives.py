@@ -0,0 +1,167 @@
+# =-=-=-=-==-=-=-=-=-=-=
+# Bulk Archive Import
+# =-=-=-=-==-=-=-=-=-=-=
+#
+# Imports many exports in one go, e.g. years of archived backups or the
+# exports of everyone in a household, where running import_to_db.py once per
+# file would parse and load them one after another:
+#
+#   python import_archives.py backups/ old/*.zip --workers 4 --user alice
+#   python import_archives.py alice=backups/alice/ bob=backups/bob/*.zip
+#
+# An argument prefixed with user_id= is imported for that user, everything
+# else for --user.
+#
+# 1. Directories and globs are expanded to the archives in them.
+# 2. Every archive (of all users) is extracted and parsed in one process pool.
+# 3. Each user's records are merged in memory and deduped by start_time.
+#    Archives are merged oldest (by mtime) first, so a record in several of
+#    the archives keeps its version from the newest one.
+# 4. Each user's merged set goes to Postgres in a single bulk load (the same
+#    COPY into staging + merge import_to_db.py uses). That only adds new
+#    start_times: a record already in the database stays as it is, even if
+#    an archive has a different version of it.
+
+import argparse
+import asyncio
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import import_to_db
+import sqlite_store
+import users
+
+ARCHIVE_EXTENSIONS = ('.zip', '.7z', '.rar', '.tar', '.tar.gz', '.tgz')
+
+
+def expand_archives(patterns):
+    # Files, directories (their archives) and globs -> archive paths, oldest first
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = [os.path.join(pattern, name) for name in os.listdir(pattern)
+                       if name.lower().endswith(ARCHIVE_EXTENSIONS)]
+        else:
+            matches = glob.glob(pattern)
+            if not matches and not glob.has_magic(pattern):
+                raise FileNotFoundError(f"No such archive: {pattern}")
+        paths.update(os.path.abspath(path) for path in matches if os.path.isfile(path))
+    return sorted(paths, key=lambda path: (os.path.getmtime(path), path))
+
+
+def parse_sources(arguments, default_user=users.DEFAULT_USER):
+    # 'alice=backups/alice/' -> ('alice', 'backups/alice/'). Arguments without
+    # a user_id= prefix, or that name an existing file as they are, belong to
+    # default_user.
+    sources = []
+    for argument in arguments:
+        user_id, separator, pattern = argument.partition('=')
+        if not separator or os.path.exists(argument) or not users.USER_ID.match(user_id):
+            user_id, pattern = default_user, argument
+        sources.append((user_id, pattern))
+    return sources
+
+
+def parse_archives(paths, workers=None):
+    # Parses every archive in a process pool. Returns one record list per
+    # archive, in the order of paths; archives that fail to parse are
+    # reported and left out.
+    results = [None] * len(paths)
+    start = time.perf_counter()
+    csv_bytes = 0
+    parsed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(import_to_db.parse_zip_data, path, None, import_to_db.COLUMNAR_PARSER, True): index
+            for index, path in enumerate(paths)
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            index = futures[future]
+            name = os.path.basename(paths[index])
+            try:
+                records, info = future.result()
+            except Exception as e:
+                print(f"[{done}/{len(paths)}] {name}: failed ({e})")
+                continue
+            results[index] = records
+            parsed += len(records)
+            csv_bytes += info.get('size', 0)
+            elapsed = time.perf_counter() - start
+            print(f"[{done}/{len(paths)}] {name}: {len(records)} records "
+                  f"({parsed} so far, {parsed / elapsed:.0f} records/sec)")
+
+    elapsed = time.perf_counter() - start
+    print(f"Parsed {parsed} records ({csv_bytes / 1024**2:.1f} MiB of CSV) in {elapsed:.2f}s "
+          f"({csv_bytes / 1024**2 / elapsed:.1f} MiB/sec)")
+    return results
+
+
+def merge_records(record_lists):
+    # Dedupes by start_time, later lists winning, and returns the records in
+    # start_time order
+    merged = {}
+    for records in record_lists:
+        for record in records or ():
+            merged[record['start_time']] = record
+    return [merged[start_time] for start_time in sorted(merged)]
+
+
+async def import_archives(patterns, user_id=users.DEFAULT_USER, workers=None):
+    # patterns may carry user_id= prefixes (see parse_sources); the rest are
+    # imported for user_id
+    archives = {}
+    for source_user, pattern in parse_sources(patterns, user_id):
+        archives.setdefault(source_user, []).append(pattern)
+    archives = {source_user: expand_archives(user_patterns) for source_user, user_patterns in archives.items()}
+    # Every archive once, oldest first, however many users it was given for
+    paths = sorted({path for user_paths in archives.values() for path in user_paths},
+                   key=lambda path: (os.path.getmtime(path), path))
+    if not paths:
+        print("No archives found")
+        return 0, 0
+    print(f"Importing {len(paths)} archives for {', '.join(sorted(archives))} "
+          f"with {workers or os.cpu_count()} workers")
+
+    start = time.perf_counter()
+    record_lists = await asyncio.get_running_loop().run_in_executor(None, parse_archives, paths, workers)
+    parsed_by_path = dict(zip(paths, record_lists))
+
+    await import_to_db.setup_database(import_to_db.DB_HOST, import_to_db.DB_USER,
+                                      import_to_db.DB_PASSWORD, import_to_db.DB_NAME)
+    total_records = new_records = 0
+    for source_user, user_paths in sorted(archives.items()):
+        if not user_paths:
+            continue
+        user_lists = [parsed_by_path[path] for path in user_paths]
+        records = merge_records(user_lists)
+        parsed = sum(len(records) for records in user_lists if records)
+        print(f"{source_user}: {len(records)} distinct records after merging "
+              f"({parsed - len(records)} duplicates across archives)")
+        user_total, user_new, _ = await import_to_db.import_to_database(records, bulk=True, user_id=source_user)
+        total_records += user_total
+        new_records += user_new
+
+    elapsed = time.perf_counter() - start
+    print(f"Imported {len(paths)} archives in {elapsed:.2f}s: {total_records} records, {new_records} new "
+          f"({total_records / elapsed:.0f} records/sec overall)")
+    return total_records, new_records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import many Sleep as Android exports into PostgreSQL at once")
+    parser.add_argument('archives', nargs='+',
+                        help="archive files, directories of archives or glob patterns, each optionally "
+                             "prefixed with user_id= to import it for that user")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="parser processes (defaults to the number of CPUs)")
+    parser.add_argument('--user', default=users.DEFAULT_USER,
+                        help="user_id of the archives without a user_id= prefix (see users.py)")
+    parser.add_argument('--sqlite', metavar='PATH',
+                        help="store into this SQLite file instead of PostgreSQL (see sqlite_store.py)")
+    args = parser.parse_args()
+    if args.sqlite:
+        import_to_db.DB_BACKEND = 'sqlite'
+        sqlite_store.SQLITE_PATH = args.sqlite
+    asyncio.run(import_archives(args.archives, args.user, args.workers))
@@ -6,17 +6,29 @@
 # parses the sleep records, and imports them into a PostgreSQL database.
 # It performs the following main functions:
 #
-# 1. Verifies and extracts the 'sleep-export.csv' file from a ZIP archive.
+# 1. Streams the sleep export CSV straight out of the uploaded ZIP archive
+#    (other archive formats are extracted to a temp dir with patoolib).
 # 2. Sets up the PostgreSQL database and creates the necessary table if not exists.
 # 3. Parses each sleep record from the CSV file, extracting relevant information.
 # 4. Imports the parsed sleep records into the database, avoiding duplicates.
+#    Records are bulk loaded into a staging table with COPY and merged in one
+#    statement; the old per-row INSERT path is kept for comparison.
+#    Each record's actigraphy series and events are stored packed alongside.
+#    Records belong to a user (see users.py) and land in that user's
+#    partition of sleep_records. Newly inserted records are also folded into
+#    the user's running statistics (see online_stats.py) and the server's
+#    cached per-location sums (see location_stats.py).
 # 5. Provides a summary of the total records processed and new records added.
 #
+# With DB_BACKEND=sqlite (or --sqlite PATH) everything is stored in a local
+# SQLite file instead, see sqlite_store.py.
+#
 # The script handles various data points such as sleep duration, cycles,
 # deep sleep, time awake, and location. It also manages timezone conversions
 # to ensure accurate timestamp storage in the database.
 
 import zipfile
+import argparse
 import csv
 import os
 import io
@@ -24,10 +36,37 @@ import asyncpg
 import asyncio
 from datetime import datetime
 from datetime import timezone as dt_timezone
-from pytz import timezone
 import patoolib
-import os
+import shutil
 import tempfile
+from contextlib import contextmanager, asynccontextmanager
+import time
+import sleep_columns
+import actigraphy
+import sleep_quality
+import location_stats
+import metrics
+import online_stats
+import sqlite_store
+import tzcache
+import users
+
+# Database connection settings, overridable through the environment
+DB_HOST = os.getenv('DB_HOST', 'db')
+DB_USER = os.getenv('DB_USER', 'postgres')
+DB_PASSWORD = os.getenv('DB_PASSWORD', 'dev_password')
+DB_NAME = os.getenv('DB_NAME', 'sleep_data')
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '5'))
+# 'postgres', or 'sqlite' for the embedded single-file backend (SQLITE_PATH)
+DB_BACKEND = os.getenv('DB_BACKEND', 'postgres')
+# SLEEP_PARSER=columnar parses exports with the NumPy loader in sleep_columns.py
+COLUMNAR_PARSER = os.getenv('SLEEP_PARSER', 'dict') == 'columnar'
+# Imports also parse records up to this many days below the high-water mark.
+# A night added by hand later, or synced from a second device, can start
+# before the newest stored one. Records in the margin are checked against the
+# stored start times rather than dropped unseen.
+HIGH_WATER_MARGIN_DAYS = float(os.getenv('HIGH_WATER_MARGIN_DAYS', '14'))
 
 def format_progress_bar(percentage, length=10):
     filled = int(percentage / 100 * length)
@@ -51,57 +90,88 @@ def format_sleep_record(record):
     awake_text = "N/A (Manually added)" if is_manually_added else f"{time_awake_percent:.1f}% {format_progress_bar(time_awake_percent) if time_awake_percent != 0 else ''}"
     deep_sleep_text = "N/A (Manually added)" if is_manually_added else f"{deep_sleep_percent:.1f}% {format_progress_bar(deep_sleep_percent) if deep_sleep_percent != 0 else ''}"
 
+    value = (f"⏰ End: <t:{end_timestamp}:t>\n"
+             f"⌛ Duration: {hours}h {minutes}m\n"
+             f"👀 Awake: {awake_text}\n"
+             f"💤 Deep sleep: {deep_sleep_text}\n")
+
+    # Movement-based metrics from the actigraphy (see sleep_quality.py)
+    quality = record.get('quality')
+    if quality:
+        longest_hours, longest_minutes = divmod(int(quality['longest_sleep_minutes']), 60)
+        value += (f"🛌 Efficiency: {quality['sleep_efficiency']:.0f}% "
+                  f"{format_progress_bar(quality['sleep_efficiency'])}\n"
+                  f"🧩 Longest stretch: {longest_hours}h {longest_minutes}m, "
+                  f"~{quality['estimated_cycles']:.0f} cycles\n")
+
     return {
         "name": f"🌙 Sleep Record: <t:{start_timestamp}:f>",
-        "value": f"⏰ End: <t:{end_timestamp}:t>\n"
-                 f"⌛ Duration: {hours}h {minutes}m\n"
-                 f"👀 Awake: {awake_text}\n"
-                 f"💤 Deep sleep: {deep_sleep_text}\n"
+        "value": value
     }
-def verify_zip(zip_data):
-    try:
-        # Create a temporary directory to extract files
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Create a temporary file to save the BytesIO content
-            temp_zip = os.path.join(temp_dir, 'temp.zip')
-            with open(temp_zip, 'wb') as f:
-                if isinstance(zip_data, io.BytesIO):
-                    f.write(zip_data.getvalue())
-                elif isinstance(zip_data, str):
-                    with open(zip_data, 'rb') as src:
-                        f.write(src.read())
-                else:
-                    raise ValueError("Invalid input type for zip_data")
-
-            # Extract the archive contents
-            extract_dir = os.path.join(temp_dir, 'extracted')
-            os.mkdir(extract_dir)
-            patoolib.extract_archive(temp_zip, outdir=extract_dir)
-            
-            # Look for the sleep export CSV file
-            for root, dirs, files in os.walk(extract_dir):
-                for file in files:
-                    if file.lower().endswith('.csv') and 'sleep' in file.lower():
-                        source_path = os.path.join(root, file)
-                        # Copy the file to the current directory and rename it
-                        os.rename(source_path, 'sleep-export.csv')
-                        print(f"Successfully extracted: {file}")
-                        return True
-            
-            raise ValueError("No sleep-related CSV file found in the archive")
-    except Exception as e:
-        print(f"Error: {str(e)}")
-        return False
+def is_sleep_csv(name):
+    name = os.path.basename(name).lower()
+    return name.endswith('.csv') and 'sleep' in name
+
+
+@contextmanager
+def open_sleep_csv(zip_data, info=None):
+    # Yields a text stream over the sleep CSV inside the archive. ZIPs (what
+    # Sleep as Android produces) are read straight from the buffer or path and
+    # the member is decompressed as it's read. Anything else goes through
+    # patoolib into a temp dir that's removed again on exit.
+    # If an info dict is given, the CSV's name and uncompressed size go in it
+    # (and for other archives, how long extracting them took).
+    info = info if info is not None else {}
+    if isinstance(zip_data, bytes):
+        zip_data = io.BytesIO(zip_data)
+    elif not isinstance(zip_data, (str, io.IOBase)):
+        raise ValueError("Invalid input type for zip_data")
+
+    if zipfile.is_zipfile(zip_data):
+        with zipfile.ZipFile(zip_data) as archive:
+            name = next((n for n in archive.namelist() if is_sleep_csv(n)), None)
+            if name is None:
+                raise ValueError("No sleep-related CSV file found in the archive")
+            info['name'], info['size'] = name, archive.getinfo(name).file_size
+            with archive.open(name) as member:
+                print(f"Streaming {name} from ZIP archive")
+                yield io.TextIOWrapper(member, encoding='utf-8', newline='')
+        return
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if isinstance(zip_data, str):
+            archive_path = zip_data
+        else:
+            archive_path = os.path.join(temp_dir, 'archive')
+            with open(archive_path, 'wb') as f:
+                zip_data.seek(0)
+                shutil.copyfileobj(zip_data, f)
+
+        extract_dir = os.path.join(temp_dir, 'extracted')
+        os.mkdir(extract_dir)
+        start = time.perf_counter()
+        patoolib.extract_archive(archive_path, outdir=extract_dir)
+        info['extract_seconds'] = time.perf_counter() - start
+
+        for root, dirs, files in os.walk(extract_dir):
+            for file in files:
+                if is_sleep_csv(file):
+                    print(f"Successfully extracted: {file}")
+                    info['name'], info['size'] = file, os.path.getsize(os.path.join(root, file))
+                    with open(os.path.join(root, file), 'r', encoding='utf-8', newline='') as csv_file:
+                        yield csv_file
+                    return
+
+        raise ValueError("No sleep-related CSV file found in the archive")
 
 
 def parse_sleep_record(row):
     id_timestamp = int(row['Id']) / 1000  # Convert milliseconds to seconds
     start_time = datetime.fromtimestamp(id_timestamp, dt_timezone.utc)
     
-    tz = timezone(row['Tz'])
     end_time_str = row['To']
     end_time = datetime.strptime(end_time_str, '%d. %m. %Y %H:%M')
-    end_time = tz.localize(end_time)
+    end_time = tzcache.localize(end_time, row['Tz'])
 
     hours = float(row['Hours'])
     len_adjust = float(row['LenAdjust'])
@@ -122,11 +192,16 @@ def parse_sleep_record(row):
         'deep_sleep': deep_sleep,
         'time_awake': time_awake,
         'location_hash': row['Geo'],
-        'comment': row['Comment']
+        'comment': row['Comment'],
+        'tz': row['Tz']
     }
 
 
 async def setup_database(host, user, password, dbname):
+    if DB_BACKEND == 'sqlite':
+        sqlite_store.setup()
+        return
+
     # Connect to default database to create new database
     conn = await asyncpg.connect(
         host=host,
@@ -151,111 +226,678 @@ async def setup_database(host, user, password, dbname):
         database=dbname
     )
 
-    # Create table if it doesn't exist
+    # Databases from before users existed get their tables converted first
+    if await conn.fetchval("SELECT relkind = 'r' FROM pg_class WHERE oid = to_regclass('sleep_records')"):
+        await migrate_to_user_partitions(conn)
+
+    # Records are keyed by user and partitioned by it, see users.py. The
+    # partitions themselves are created by ensure_user_partition.
     await conn.execute("""
         CREATE TABLE IF NOT EXISTS sleep_records (
-            start_time TIMESTAMP WITH TIME ZONE PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            start_time TIMESTAMP WITH TIME ZONE,
             end_time TIMESTAMP WITH TIME ZONE,
             sleep_duration FLOAT,
             cycles INTEGER,
             deep_sleep FLOAT,
             time_awake INTEGER,
             location_hash TEXT,
-            comment TEXT
+            comment TEXT,
+            tz TEXT,
+            PRIMARY KEY (user_id, start_time)
+        ) PARTITION BY LIST (user_id)
+    """)
+
+    # Window stats look for records ending after the window start; start_time
+    # is already covered by the primary key
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS sleep_records_end_time_idx ON sleep_records (user_id, end_time)
+    """)
+    # Covers every column location_stats.LOCATION_QUERY reads, so on large
+    # partitions its GROUP BY is answered by an index-only scan
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS sleep_records_location_idx ON sleep_records (user_id, location_hash)
+        INCLUDE (start_time, sleep_duration, deep_sleep, time_awake)
+    """)
+    
+    # Daily rollup for reports, keyed by the local calendar day (in the
+    # record's Tz) the session ended on
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS sleep_daily (
+            user_id TEXT NOT NULL,
+            day DATE,
+            total_sleep_minutes FLOAT,
+            record_count INTEGER,
+            min_session_minutes FLOAT,
+            max_session_minutes FLOAT,
+            deep_sleep_minutes FLOAT,
+            awake_minutes INTEGER,
+            PRIMARY KEY (user_id, day)
+        )
+    """)
+    # Per-record actigraphy series and events, packed (see actigraphy.py)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS sleep_actigraphy (
+            user_id TEXT NOT NULL,
+            start_time TIMESTAMP WITH TIME ZONE,
+            samples BYTEA,
+            events BYTEA,
+            PRIMARY KEY (user_id, start_time),
+            FOREIGN KEY (user_id, start_time) REFERENCES sleep_records (user_id, start_time) ON DELETE CASCADE
+        )
+    """)
+    # Digests of uploads already processed, so the server can answer a
+    # re-upload of the same export without running the pipeline again
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS upload_digests (
+            user_id TEXT NOT NULL,
+            digest TEXT,
+            size BIGINT,
+            result TEXT,
+            records_parsed INTEGER,
+            records_inserted INTEGER,
+            first_seen TIMESTAMP WITH TIME ZONE DEFAULT now(),
+            last_seen TIMESTAMP WITH TIME ZONE DEFAULT now(),
+            hits INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, digest)
+        )
+    """)
+    # Each user's running statistics, see online_stats.py
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS sleep_online_stats (
+            user_id TEXT PRIMARY KEY,
+            state JSONB NOT NULL,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT now()
         )
     """)
+
+    for user_id in users.all_users():
+        await ensure_user_partition(conn, user_id)
+
+    if await conn.fetchval("SELECT NOT EXISTS (SELECT 1 FROM sleep_daily) AND EXISTS (SELECT 1 FROM sleep_records)"):
+        await rebuild_daily_rollup(conn)
+
+    # States from an older online_stats.STATE_VERSION, and users with records
+    # but no state yet (databases from before it existed)
+    stale = await conn.fetch(
+        "SELECT user_id FROM sleep_online_stats WHERE (state->>'version')::int IS DISTINCT FROM $1",
+        online_stats.STATE_VERSION
+    )
+    missing = [
+        user_id for user_id in users.all_users()
+        if await conn.fetchval(
+            "SELECT EXISTS (SELECT 1 FROM sleep_records WHERE user_id = $1) "
+            "AND NOT EXISTS (SELECT 1 FROM sleep_online_stats WHERE user_id = $1)", user_id
+        )
+    ]
+    for user_id in sorted({row['user_id'] for row in stale} | set(missing)):
+        await rebuild_online_stats(conn, user_id)
     
     await conn.close()
     print(f"Table 'sleep_records' is set up in database '{dbname}'.")
-async def import_to_database(records):
+
+
+async def migrate_to_user_partitions(conn):
+    # Moves a single-user database to the per-user layout. Everything in it
+    # becomes DEFAULT_USER's; the old sleep_records is copied into that user's
+    # partition and dropped.
+    legacy_user = users.DEFAULT_USER
+    print(f"Migrating sleep_records to per-user partitions (existing records go to '{legacy_user}')")
+    async with conn.transaction():
+        await conn.execute("ALTER TABLE sleep_records ADD COLUMN IF NOT EXISTS tz TEXT")
+        await conn.execute("ALTER TABLE IF EXISTS sleep_actigraphy DROP CONSTRAINT IF EXISTS sleep_actigraphy_start_time_fkey")
+        await conn.execute("ALTER TABLE sleep_records RENAME TO sleep_records_legacy")
+        await conn.execute("ALTER TABLE sleep_records_legacy RENAME CONSTRAINT sleep_records_pkey TO sleep_records_legacy_pkey")
+        await conn.execute("DROP INDEX IF EXISTS sleep_records_end_time_idx")
+        await conn.execute("""
+            CREATE TABLE sleep_records (
+                user_id TEXT NOT NULL,
+                start_time TIMESTAMP WITH TIME ZONE,
+                end_time TIMESTAMP WITH TIME ZONE,
+                sleep_duration FLOAT,
+                cycles INTEGER,
+                deep_sleep FLOAT,
+                time_awake INTEGER,
+                location_hash TEXT,
+                comment TEXT,
+                tz TEXT,
+                PRIMARY KEY (user_id, start_time)
+            ) PARTITION BY LIST (user_id)
+        """)
+        await ensure_user_partition(conn, legacy_user)
+        copied = await conn.execute(f"""
+            INSERT INTO sleep_records (user_id, {', '.join(RECORD_COLUMNS[1:])})
+            SELECT $1, {', '.join(RECORD_COLUMNS[1:])} FROM sleep_records_legacy
+        """, legacy_user)
+        await conn.execute("DROP TABLE sleep_records_legacy")
+
+        # The other tables just gain a user_id in their key
+        keys = {'sleep_daily': 'day', 'sleep_actigraphy': 'start_time', 'upload_digests': 'digest'}
+        for table, key in keys.items():
+            if await conn.fetchval("SELECT to_regclass($1)", table) is None:
+                continue
+            await conn.execute(f"ALTER TABLE {table} ADD COLUMN user_id TEXT NOT NULL DEFAULT {users.quote_literal(legacy_user)}")
+            await conn.execute(f"ALTER TABLE {table} ALTER COLUMN user_id DROP DEFAULT")
+            await conn.execute(f"ALTER TABLE {table} DROP CONSTRAINT {table}_pkey")
+            await conn.execute(f"ALTER TABLE {table} ADD PRIMARY KEY (user_id, {key})")
+        if await conn.fetchval("SELECT to_regclass('sleep_actigraphy')") is not None:
+            await conn.execute("""
+                ALTER TABLE sleep_actigraphy ADD FOREIGN KEY (user_id, start_time)
+                REFERENCES sleep_records (user_id, start_time) ON DELETE CASCADE
+            """)
+    # Only now that the transaction committed is the partition known to exist
+    _user_partitions.add(legacy_user)
+    print(f"Migration done ({copied.split()[-1]} records).")
+
+
+# Users whose sleep_records partition is known to exist (per process)
+_user_partitions = set()
+
+
+async def ensure_user_partition(conn, user_id):
+    if user_id in _user_partitions:
+        return
+    if not users.USER_ID.match(user_id):
+        raise ValueError(f"Invalid user_id {user_id!r}")
+    await conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {users.partition_name(user_id)}
+        PARTITION OF sleep_records FOR VALUES IN ({users.quote_literal(user_id)})
+    """)
+    # Created inside a transaction, the partition is gone again if that rolls
+    # back; the caller marks it once the transaction has committed
+    if not conn.is_in_transaction():
+        _user_partitions.add(user_id)
+
+
+async def create_pool(min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE):
+    # Sets up the schema once and returns a pool for the long-running server
+    await setup_database(DB_HOST, DB_USER, DB_PASSWORD, DB_NAME)
+    pool = await asyncpg.create_pool(
+        host=DB_HOST,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        database=DB_NAME,
+        min_size=min_size,
+        max_size=max_size
+    )
+    print(f"Connection pool to '{DB_NAME}' on '{DB_HOST}' ready ({min_size}-{max_size} connections).")
+    return pool
+
+
+@asynccontextmanager
+async def connect(pool=None):
+    # Borrow a connection from the pool if we have one, otherwise open a
+    # one-off connection (CLI use)
+    if pool is not None:
+        async with pool.acquire() as conn:
+            yield conn
+        return
+
     conn = await asyncpg.connect(
-        host="db",
-        user="postgres",
-        password="dev_password",
-        database="sleep_data"
+        host=DB_HOST,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        database=DB_NAME
     )
-    
-    total_records = 0
-    new_records = 0
-    new_record_details = []
+    try:
+        yield conn
+    finally:
+        await conn.close()
+
+
+RECORD_COLUMNS = [
+    'user_id', 'start_time', 'end_time', 'sleep_duration', 'cycles',
+    'deep_sleep', 'time_awake', 'location_hash', 'comment', 'tz'
+]
+
+
+async def import_to_database(records, bulk=True, pool=None, user_id=users.DEFAULT_USER):
+    start = time.perf_counter()
+    for record in records:
+        record['user_id'] = user_id
+    if DB_BACKEND == 'sqlite':
+        # Always executemany, and no rollup to maintain
+        with metrics.span('db_insert'):
+            inserted, state = sqlite_store.import_records(records, user_id)
+    else:
+        with location_stats.importing(user_id):
+            async with connect(pool) as conn:
+                await ensure_user_partition(conn, user_id)
+                async with conn.transaction():
+                    with metrics.span('db_insert'):
+                        if bulk:
+                            inserted = await bulk_insert_records(conn, records)
+                        else:
+                            inserted = await insert_records(conn, records)
+                    with metrics.span('db_rollup'):
+                        await refresh_daily_rollup(conn, inserted, user_id)
+                    with metrics.span('db_actigraphy'):
+                        await store_actigraphy(conn, records)
+                    with metrics.span('db_online_stats'):
+                        state = await update_online_stats(conn, inserted, user_id)
+            location_stats.records_inserted(user_id, inserted)
+    elapsed = time.perf_counter() - start
+
+    total_records = len(records)
+    new_records = len(inserted)
+    with metrics.span('quality'):
+        for record, quality in zip(inserted, sleep_quality.analyze_records(inserted)):
+            record['quality'] = quality
+    new_record_details = [format_sleep_record(record) for record in inserted]
+    # Trends for the notification, read from the running stats rather than the history
+    stats = online_stats.summary(state) if inserted else None
+    if stats is not None:
+        new_record_details.append(online_stats.format_summary(stats))
+
+    rate = total_records / elapsed if elapsed > 0 else 0
+    print(f"Total sleep records processed: {total_records}")
+    print(f"New sleep records added to the database: {new_records}")
+    method = 'sqlite' if DB_BACKEND == 'sqlite' else 'bulk' if bulk else 'per-row'
+    print(f"Import ({method}) took {elapsed:.3f}s ({rate:.0f} rows/sec)")
+    return total_records, new_records, new_record_details
+
+
+async def insert_records(conn, records):
+    # Returns the records that were actually inserted
+    inserted = []
     
     for record in records:
         result = await conn.fetchrow("""
             INSERT INTO sleep_records 
-            (start_time, end_time, sleep_duration, cycles, deep_sleep, time_awake, location_hash, comment)
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
-            ON CONFLICT (start_time) DO NOTHING
+            (user_id, start_time, end_time, sleep_duration, cycles, deep_sleep, time_awake, location_hash, comment, tz)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+            ON CONFLICT (user_id, start_time) DO NOTHING
             RETURNING start_time
-        """, record['start_time'], record['end_time'], record['sleep_duration'],
+        """, record['user_id'], record['start_time'], record['end_time'], record['sleep_duration'],
               record['cycles'], record['deep_sleep'], record['time_awake'],
-              record['location_hash'], record['comment'])
+              record['location_hash'], record['comment'], record['tz'])
         
-        total_records += 1
         if result is not None:
-            new_records += 1
-            new_record_details.append(format_sleep_record(record))
-    
-    await conn.close()
-    
-    print(f"Total sleep records processed: {total_records}")
-    print(f"New sleep records added to the database: {new_records}")
-    return total_records, new_records, new_record_details
+            inserted.append(record)
+
+    return inserted
+
+
+async def bulk_insert_records(conn, records):
+    # Stream everything into a temp staging table with COPY, then merge it
+    # into sleep_records with a single INSERT ... SELECT. Only the rows that
+    # were actually inserted come back, and those records are returned.
+    # All records are one user's, so start_time identifies them.
+    async with conn.transaction():
+        await conn.execute("""
+            CREATE TEMP TABLE sleep_records_staging
+            (LIKE sleep_records INCLUDING DEFAULTS)
+            ON COMMIT DROP
+        """)
+        await conn.copy_records_to_table(
+            'sleep_records_staging',
+            records=(tuple(record[column] for column in RECORD_COLUMNS) for record in records),
+            columns=RECORD_COLUMNS
+        )
+        rows = await conn.fetch(f"""
+            INSERT INTO sleep_records ({', '.join(RECORD_COLUMNS)})
+            SELECT {', '.join(RECORD_COLUMNS)} FROM sleep_records_staging
+            ON CONFLICT (user_id, start_time) DO NOTHING
+            RETURNING start_time
+        """)
+
+    inserted_times = {row['start_time'] for row in rows}
+    inserted = []
+    for record in records:
+        if record['start_time'] in inserted_times:
+            inserted_times.discard(record['start_time'])
+            inserted.append(record)
+    return inserted
+
+
+async def store_actigraphy(conn, records):
+    # Saves the packed actigraphy/events of every parsed record that has any
+    # and isn't stored yet. Incremental imports only parse new records; a
+    # full rescan backfills records imported before this table existed.
+    rows = [
+        (record['user_id'], record['start_time'],
+         actigraphy.pack_samples(record['actigraphy']), actigraphy.pack_events(record['events']))
+        for record in records
+        if len(record.get('actigraphy', ())) or len(record.get('events', ()))
+    ]
+    if not rows:
+        return
+
+    async with conn.transaction():
+        await conn.execute("""
+            CREATE TEMP TABLE sleep_actigraphy_staging
+            (LIKE sleep_actigraphy)
+            ON COMMIT DROP
+        """)
+        await conn.copy_records_to_table(
+            'sleep_actigraphy_staging',
+            records=rows,
+            columns=['user_id', 'start_time', 'samples', 'events']
+        )
+        await conn.execute("""
+            INSERT INTO sleep_actigraphy (user_id, start_time, samples, events)
+            SELECT user_id, start_time, samples, events FROM sleep_actigraphy_staging
+            ON CONFLICT (user_id, start_time) DO NOTHING
+        """)
+
+
+# Local day a record belongs to: the day its session ended, in its own Tz.
+# Rows imported before the tz column existed fall back to UTC.
+DAILY_ROLLUP_DAY = "(end_time AT TIME ZONE COALESCE(tz, 'UTC'))::date"
+DAILY_ROLLUP_SELECT = f"""
+    SELECT user_id,
+           {DAILY_ROLLUP_DAY} AS day,
+           SUM(sleep_duration * 60),
+           COUNT(*),
+           MIN(sleep_duration * 60),
+           MAX(sleep_duration * 60),
+           SUM(sleep_duration * 60 * deep_sleep),
+           SUM(time_awake)
+    FROM sleep_records
+"""
+
+
+async def refresh_daily_rollup(conn, records, user_id=users.DEFAULT_USER):
+    # Recomputes one user's sleep_daily rows for just the days touched by the
+    # given (newly inserted) records. end_time is already in the record's own zone.
+    days = sorted({record['end_time'].date() for record in records})
+    if not days:
+        return
+
+    # Pad the end_time range by two days to cover any UTC offset
+    await conn.execute(f"""
+        INSERT INTO sleep_daily (user_id, day, total_sleep_minutes, record_count, min_session_minutes,
+                                 max_session_minutes, deep_sleep_minutes, awake_minutes)
+        {DAILY_ROLLUP_SELECT}
+        WHERE user_id = $4
+          AND end_time >= $2::date - 2 AND end_time < $3::date + 2
+          AND {DAILY_ROLLUP_DAY} = ANY($1::date[])
+        GROUP BY 1, 2
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            total_sleep_minutes = EXCLUDED.total_sleep_minutes,
+            record_count = EXCLUDED.record_count,
+            min_session_minutes = EXCLUDED.min_session_minutes,
+            max_session_minutes = EXCLUDED.max_session_minutes,
+            deep_sleep_minutes = EXCLUDED.deep_sleep_minutes,
+            awake_minutes = EXCLUDED.awake_minutes
+    """, days, days[0], days[-1], user_id)
+
+
+async def update_online_stats(conn, records, user_id=users.DEFAULT_USER):
+    # Folds the newly inserted records into the user's persisted stats and
+    # returns the new state. Row-locked, so concurrent imports don't lose updates.
+    data = await conn.fetchval("SELECT state::text FROM sleep_online_stats WHERE user_id = $1 FOR UPDATE", user_id)
+    state = online_stats.load(data)
+    if not records:
+        return state
+    online_stats.update(state, records)
+    await conn.execute("""
+        INSERT INTO sleep_online_stats (user_id, state) VALUES ($1, $2::jsonb)
+        ON CONFLICT (user_id) DO UPDATE SET state = EXCLUDED.state, updated_at = now()
+    """, user_id, online_stats.dump(state))
+    return state
+
+
+async def rebuild_online_stats(conn, user_id):
+    # Recomputes a user's stats from all their records, oldest night first
+    async with conn.transaction():
+        state = online_stats.new_state()
+        async for row in conn.cursor(f"""
+            SELECT {DAILY_ROLLUP_DAY} AS day, end_time, sleep_duration, deep_sleep
+            FROM sleep_records WHERE user_id = $1
+            ORDER BY 1, end_time
+        """, user_id, prefetch=10000):
+            online_stats.update(state, [row])
+        await conn.execute("""
+            INSERT INTO sleep_online_stats (user_id, state) VALUES ($1, $2::jsonb)
+            ON CONFLICT (user_id) DO UPDATE SET state = EXCLUDED.state, updated_at = now()
+        """, user_id, online_stats.dump(state))
+    print(f"Rebuilt online stats for {user_id}: {state['sessions']['count']} sessions.")
+
+
+async def rebuild_daily_rollup(conn):
+    async with conn.transaction():
+        await conn.execute("TRUNCATE sleep_daily")
+        await conn.execute(f"""
+            INSERT INTO sleep_daily (user_id, day, total_sleep_minutes, record_count, min_session_minutes,
+                                     max_session_minutes, deep_sleep_minutes, awake_minutes)
+            {DAILY_ROLLUP_SELECT}
+            GROUP BY 1, 2
+        """)
+    days = await conn.fetchval("SELECT COUNT(*) FROM sleep_daily")
+    print(f"Rebuilt sleep_daily: {days} days.")
+
 
+def iter_csv_rows(csv_file):
+    # The export alternates a header row and a value row for every record
+    csv_reader = csv.reader(csv_file)
+    while True:
+        try:
+            header = next(csv_reader)
+            values = next(csv_reader)
+        except StopIteration:
+            return
+        yield header, values
+
+
+def process_sleep_data(csv_file, since_ms=None, info=None):
+    # When since_ms is given, records whose raw Id (start time in ms) is at or
+    # below it are skipped before any timezone/strptime work happens. If an
+    # info dict is given, the number skipped goes in info['records_skipped'].
+    if isinstance(csv_file, str):
+        with open(csv_file, 'r', encoding='utf-8', newline='') as file:
+            return process_sleep_data(file, since_ms, info)
 
-def process_sleep_data(csv_file):
     records = []
-    with open(csv_file, 'r') as file:
-        csv_reader = csv.reader(file)
-
-        while True:
-            try:
-                header = next(csv_reader)
-                values = next(csv_reader)
-                row = dict(zip(header, values))
-                record = parse_sleep_record(row)
-                records.append(record)
-            except StopIteration:
-                break
+    skipped = 0
+    for header, values in iter_csv_rows(csv_file):
+        row = dict(zip(header, values))
+        if since_ms is not None and int(row['Id']) <= since_ms:
+            skipped += 1
+            continue
+        record = parse_sleep_record(row)
+        record['actigraphy'], record['events'] = actigraphy.parse_actigraphy(header, values)
+        records.append(record)
 
+    if skipped:
+        print(f"Skipped {skipped} already imported records (Id <= {since_ms})")
+    if info is not None:
+        info['records_skipped'] = skipped
     return records
 
 
-async def process_zip_data(zip_data):
-    zip_file = io.BytesIO(zip_data)
-    if verify_zip(zip_file):
-        records = process_sleep_data('sleep-export.csv')
-        total_records, new_records, new_record_details = await import_to_database(records)
-        os.remove('sleep-export.csv')
-        print(f"Sleep data processed successfully. {total_records} records processed, {new_records} new records added.")
-        return True, new_records, new_record_details
+# Each user's newest start_time in the database as an Id-style millisecond
+# timestamp. Loaded once per process and bumped after every successful import.
+_high_water_marks = {}
+
+
+async def get_high_water_mark(pool=None, user_id=users.DEFAULT_USER):
+    if user_id not in _high_water_marks:
+        if DB_BACKEND == 'sqlite':
+            latest = sqlite_store.latest_start_time(user_id)
+        else:
+            async with connect(pool) as conn:
+                latest = await conn.fetchval("SELECT max(start_time) FROM sleep_records WHERE user_id = $1", user_id)
+        # No records yet means no mark; -1 keeps us from querying it again.
+        _high_water_marks[user_id] = to_id_ms(latest) if latest is not None else -1
+    return _high_water_marks[user_id]
+
+
+def update_high_water_mark(records, user_id=users.DEFAULT_USER):
+    if user_id not in _high_water_marks or not records:
+        return
+    latest = max(to_id_ms(record['start_time']) for record in records)
+    _high_water_marks[user_id] = max(_high_water_marks[user_id], latest)
+
+
+def to_id_ms(start_time):
+    return round(start_time.timestamp() * 1000)
+
+
+async def stored_ids_since(since_ms, pool=None, user_id=users.DEFAULT_USER):
+    # The Id-style start times of the user's records after since_ms, to tell
+    # which records parsed from the high-water margin are already stored
+    since = datetime.fromtimestamp(since_ms / 1000, dt_timezone.utc)
+    if DB_BACKEND == 'sqlite':
+        starts = sqlite_store.start_times_since(since, user_id)
     else:
+        async with connect(pool) as conn:
+            rows = await conn.fetch(
+                "SELECT start_time FROM sleep_records WHERE user_id = $1 AND start_time > $2", user_id, since
+            )
+        starts = [row['start_time'] for row in rows]
+    return {to_id_ms(start) for start in starts}
+
+
+def process_sleep_data_columnar(csv_file, since_ms=None, info=None):
+    # Same records as process_sleep_data, built from the vectorized loader
+    columns = sleep_columns.load_sleep_columns(csv_file, since_ms, with_actigraphy=True, info=info)
+    return list(sleep_columns.iter_records(columns))
+
+
+def parse_zip_data(zip_data, since_ms=None, columnar=COLUMNAR_PARSER, with_info=False):
+    # The synchronous extract + parse stage. Kept as a plain module-level
+    # function so the server can run it in a thread or process pool.
+    # with_info=True returns (records, info) instead, info being the
+    # open_sleep_csv details plus parse_seconds and records_skipped (below the
+    # high-water mark), since a pool worker can't record metrics for the
+    # server itself.
+    info = {}
+    with open_sleep_csv(zip_data, info) as csv_file:
+        start = time.perf_counter()
+        if columnar:
+            records = process_sleep_data_columnar(csv_file, since_ms=since_ms, info=info)
+        else:
+            records = process_sleep_data(csv_file, since_ms=since_ms, info=info)
+        info['parse_seconds'] = time.perf_counter() - start
+    return (records, info) if with_info else records
+
+
+@contextmanager
+def timed_stage(progress, name):
+    # A metrics span that also marks the current stage on a progress dict (an
+    # upload job, see upload_jobs.py) and records its time under progress['timings']
+    if progress is not None:
+        progress['stage'] = name
+    with metrics.span(name) as span:
+        try:
+            yield
+        finally:
+            if progress is not None:
+                progress['timings'][name] = round(time.perf_counter() - span['start'], 3)
+
+
+async def process_zip_data(zip_data, bulk=True, full_rescan=False, pool=None, executor=None, progress=None,
+                           user_id=users.DEFAULT_USER):
+    mark = None if full_rescan else await get_high_water_mark(pool, user_id)
+    # Only records above the mark are new, except for back-dated ones just
+    # below it (see HIGH_WATER_MARGIN_DAYS); older back-dated records need a
+    # full rescan
+    since_ms = mark - round(HIGH_WATER_MARGIN_DAYS * 86400 * 1000) if mark is not None and mark >= 0 else mark
+    loop = asyncio.get_running_loop()
+    try:
+        with timed_stage(progress, 'extract_parse'):
+            records, info = await loop.run_in_executor(
+                executor, parse_zip_data, zip_data, since_ms, COLUMNAR_PARSER, True
+            )
+    except Exception as e:
+        print(f"Error: {str(e)}")
         print("Failed to process sleep data")
+        if progress is not None:
+            progress['error'] = str(e)
         return False, 0, []
 
-async def main(zip_data=None):
-    host = "db"
-    user = "postgres"
-    password = "dev_password"
-    dbname = "sleep_data"
+    if 'extract_seconds' in info:
+        metrics.observe('stage_seconds', info['extract_seconds'], stage='extract')
+    metrics.observe('stage_seconds', info['parse_seconds'], stage='parse')
+    metrics.inc('records_parsed', len(records))
+    if progress is not None:
+        progress['progress'].update(bytes_extracted=info.get('size', 0), records_parsed=len(records))
 
-    await setup_database(host, user, password, dbname)
+    # The parse already dropped everything below the margin; of the records in
+    # it, those already stored are left out here
+    if records and since_ms is not None and since_ms >= 0:
+        stored = await stored_ids_since(since_ms, pool, user_id)
+        parsed = len(records)
+        records = [record for record in records if to_id_ms(record['start_time']) not in stored]
+        info['records_skipped'] += parsed - len(records)
+    # Skipped are both the records the parse dropped below the margin or found
+    # stored above, and the ones the import found already stored
+    metrics.inc('records_skipped', info['records_skipped'])
 
-    if zip_data:
-        success, new_records, new_record_details = await process_zip_data(zip_data)
-        return success, new_records, new_record_details
-    else:
-        zip_file = 'sleep-export.zip'
-        if verify_zip(zip_file):
-            records = process_sleep_data('sleep-export.csv')
-            total_records, new_records, new_record_details = await import_to_database(records)
-            os.remove('sleep-export.csv')
-            print(f"Sleep data processed successfully. {total_records} records processed, {new_records} new records added.")
-            return True, new_records, new_record_details
-        else:
-            print("Failed to process sleep data")
-            return False, 0, []
+    # An export with no new records (e.g. re-sent after cancelled tracking)
+    # has nothing left to import
+    if not records and mark is not None and mark >= 0:
+        print(f"No records newer than Id {mark} in the export, nothing to do")
+        if progress is not None:
+            progress['progress']['records_inserted'] = 0
+        return True, 0, []
 
-if __name__ == "__main__":
-    asyncio.run(main())
+    with timed_stage(progress, 'import'):
+        total_records, new_records, new_record_details = await import_to_database(
+            records, bulk=bulk, pool=pool, user_id=user_id
+        )
+    metrics.inc('records_inserted', new_records)
+    metrics.inc('records_skipped', total_records - new_records)
+    if progress is not None:
+        progress['progress']['records_inserted'] = new_records
+    update_high_water_mark(records, user_id)
+    print(f"Sleep data processed successfully. {total_records} records processed, {new_records} new records added.")
+    return True, new_records, new_record_details
+
+async def main(zip_data=None, bulk=True, full_rescan=False, pool=None, executor=None, progress=None,
+               user_id=users.DEFAULT_USER):
+    # A pool comes from the upload server, which has already set up the schema
+    if pool is None:
+        await setup_database(DB_HOST, DB_USER, DB_PASSWORD, DB_NAME)
+
+    if not zip_data:
+        zip_data = 'sleep-export.zip'
+    success, new_records, new_record_details = await process_zip_data(
+        zip_data, bulk=bulk, full_rescan=full_rescan, pool=pool, executor=executor, progress=progress,
+        user_id=user_id
+    )
+    return success, new_records, new_record_details
+
+async def rebuild_daily():
+    if DB_BACKEND == 'sqlite':
+        print("The SQLite backend has no sleep_daily rollup to rebuild.")
+        return
+    await setup_database(DB_HOST, DB_USER, DB_PASSWORD, DB_NAME)
+    async with connect() as conn:
+        await rebuild_daily_rollup(conn)
 
+async def rebuild_all_online_stats():
+    await setup_database(DB_HOST, DB_USER, DB_PASSWORD, DB_NAME)
+    if DB_BACKEND == 'sqlite':
+        sqlite_store.rebuild_all_online_stats()
+        return
+    async with connect() as conn:
+        for row in await conn.fetch("SELECT DISTINCT user_id FROM sleep_records ORDER BY 1"):
+            await rebuild_online_stats(conn, row['user_id'])
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import a Sleep as Android export into PostgreSQL (or SQLite)")
+    parser.add_argument('--per-row', action='store_true',
+                        help="use the old one-INSERT-per-record path instead of the bulk COPY import")
+    parser.add_argument('--full-rescan', action='store_true',
+                        help="parse every record instead of only those newer than the latest one in the database, "
+                             "less HIGH_WATER_MARGIN_DAYS (for backfills, and records back-dated further than that)")
+    parser.add_argument('--user', default=users.DEFAULT_USER,
+                        help="user_id the records belong to (see users.py)")
+    parser.add_argument('--rebuild-daily', action='store_true',
+                        help="regenerate the sleep_daily rollup from sleep_records and exit")
+    parser.add_argument('--rebuild-online-stats', action='store_true',
+                        help="recompute every user's running statistics from their records and exit")
+    parser.add_argument('--sqlite', metavar='PATH',
+                        help="store into this SQLite file instead of PostgreSQL (see sqlite_store.py)")
+    args = parser.parse_args()
+    if args.sqlite:
+        DB_BACKEND = 'sqlite'
+        sqlite_store.SQLITE_PATH = args.sqlite
+    if args.rebuild_daily:
+        asyncio.run(rebuild_daily())
+    elif args.rebuild_online_stats:
+        asyncio.run(rebuild_all_online_stats())
+    else:
+        asyncio.run(main(bulk=not args.per_row, full_rescan=args.full_rescan, user_id=args.user))
@@ -0,0 +1,191 @@
+# =-=-=-=-==-=-=-=-=-=
+# Sleep by Location
+# =-=-=-=-==-=-=-=-=-=
+#
+# Per-place sleep stats from the records' location_hash (the export's Geo
+# field, a geohash), for GET /stats/locations:
+#
+#   /stats/locations?precision=5&years=5&home=u2mw1
+#
+# Sessions are rolled up by the first `precision` characters of their
+# geohash, so nearby cells count as one place (5 characters is a few km
+# across). The place with the most sessions is home unless ?home= gives a
+# geohash (a shorter one covers every place inside it); everything else is
+# away. ?years= limits it to the last N calendar years.
+#
+# Each user's sums per (geohash, year) are loaded once with a GROUP BY that
+# sleep_records_location_idx covers, kept in memory, and import_to_database
+# adds newly inserted records to them, so a request only rolls up a few
+# hundred cells. Imports by other processes (the CLI) show up
+# once the cache expires after LOCATION_CACHE_SECONDS.
+
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import users
+
+LOCATION_CACHE_SECONDS = int(os.getenv('LOCATION_CACHE_SECONDS', '3600'))
+DEFAULT_PRECISION = 5
+MAX_PRECISION = 12
+
+LOCATION_QUERY = """
+    SELECT COALESCE(location_hash, '') AS location_hash,
+           EXTRACT(YEAR FROM start_time AT TIME ZONE 'UTC')::int AS year,
+           COUNT(*) AS sessions,
+           COALESCE(SUM(sleep_duration), 0)::float8 AS hours,
+           COALESCE(SUM(sleep_duration * deep_sleep) FILTER (WHERE deep_sleep >= 0), 0)::float8 AS deep_hours,
+           COALESCE(SUM(sleep_duration) FILTER (WHERE deep_sleep >= 0), 0)::float8 AS deep_tracked_hours,
+           COALESCE(SUM(time_awake), 0)::float8 AS awake_minutes,
+           COUNT(time_awake) AS awake_sessions,
+           EXTRACT(EPOCH FROM MIN(start_time))::float8 AS first_seen,
+           EXTRACT(EPOCH FROM MAX(start_time))::float8 AS last_seen
+    FROM sleep_records
+    WHERE user_id = $1
+    GROUP BY 1, 2
+"""
+
+SUMS = ('sessions', 'hours', 'deep_hours', 'deep_tracked_hours', 'awake_minutes', 'awake_sessions')
+
+# user_id -> {'loaded_at': monotonic time, 'cells': {(geohash, year): sums}}
+_cache = {}
+# Bumped whenever an import starts or ends; see get_cells
+_generations = defaultdict(int)
+_importing = defaultdict(int)
+
+
+def new_cell():
+    return dict(dict.fromkeys(SUMS, 0), first_seen=None, last_seen=None)
+
+
+def add_cell(total, cell):
+    for key in SUMS:
+        total[key] += cell[key]
+    for key, pick in (('first_seen', min), ('last_seen', max)):
+        if cell[key] is not None:
+            total[key] = cell[key] if total[key] is None else pick(total[key], cell[key])
+
+
+def add_record(cells, record):
+    start = record['start_time'].timestamp()
+    year = datetime.fromtimestamp(start, timezone.utc).year
+    hours = record['sleep_duration'] or 0.0
+    deep = record['deep_sleep']
+    cell = {
+        'sessions': 1,
+        'hours': hours,
+        'deep_hours': hours * deep if deep is not None and deep >= 0 else 0.0,
+        'deep_tracked_hours': hours if deep is not None and deep >= 0 else 0.0,
+        'awake_minutes': record['time_awake'] or 0,
+        'awake_sessions': 1 if record['time_awake'] is not None else 0,
+        'first_seen': start,
+        'last_seen': start,
+    }
+    add_cell(cells.setdefault((record['location_hash'] or '', year), new_cell()), cell)
+
+
+async def load_cells(pool, user_id):
+    rows = await pool.fetch(LOCATION_QUERY, user_id)
+    return {(row['location_hash'], row['year']): dict(row) for row in rows}
+
+
+async def get_cells(pool, user_id=users.DEFAULT_USER):
+    # The user's cached sums, loaded if missing or expired. A load that
+    # overlaps an import isn't cached (it may or may not include the
+    # import's rows), only returned.
+    entry = _cache.get(user_id)
+    if entry is not None and time.monotonic() - entry['loaded_at'] < LOCATION_CACHE_SECONDS:
+        return entry['cells']
+
+    generation = _generations[user_id]
+    cells = await load_cells(pool, user_id)
+    if generation == _generations[user_id] and not _importing[user_id]:
+        _cache[user_id] = {'loaded_at': time.monotonic(), 'cells': cells}
+    return cells
+
+
+@contextmanager
+def importing(user_id):
+    # Wraps an import of user_id's records; call records_inserted once they
+    # are committed
+    _generations[user_id] += 1
+    _importing[user_id] += 1
+    try:
+        yield
+    finally:
+        _importing[user_id] -= 1
+        _generations[user_id] += 1
+
+
+def records_inserted(user_id, records):
+    # Adds committed records to the user's cached sums, if there are any
+    entry = _cache.get(user_id)
+    if entry is None:
+        return
+    for record in records:
+        add_record(entry['cells'], record)
+
+
+def parse_location_query(query):
+    # ?precision=&years=&home= -> (precision, years, home); raises ValueError
+    precision = int(query.get('precision') or DEFAULT_PRECISION)
+    if not 1 <= precision <= MAX_PRECISION:
+        raise ValueError(f"precision must be between 1 and {MAX_PRECISION}")
+    years = int(query['years']) if query.get('years') else None
+    if years is not None and years < 1:
+        raise ValueError("years must be at least 1")
+    return precision, years, query.get('home') or None
+
+
+def describe(place, sums):
+    return {
+        'location': place,
+        'sessions': sums['sessions'],
+        'avg_hours': sums['hours'] / sums['sessions'],
+        'avg_deep_sleep_percent': (sums['deep_hours'] / sums['deep_tracked_hours'] * 100
+                                   if sums['deep_tracked_hours'] else None),
+        'avg_awake_minutes': sums['awake_minutes'] / sums['awake_sessions'] if sums['awake_sessions'] else None,
+        'first_seen': datetime.fromtimestamp(sums['first_seen'], timezone.utc).date().isoformat(),
+        'last_seen': datetime.fromtimestamp(sums['last_seen'], timezone.utc).date().isoformat(),
+    }
+
+
+def summarize(cells, precision=DEFAULT_PRECISION, years=None, home=None, now=None):
+    # Rolls the cells up to places and splits them into home and away.
+    # Sessions without a location only show up under 'unknown'.
+    now = now or datetime.now(timezone.utc)
+    places = defaultdict(new_cell)
+    unknown = new_cell()
+    for (geohash, year), sums in cells.items():
+        if years is not None and year <= now.year - years:
+            continue
+        add_cell(places[geohash[:precision]] if geohash else unknown, sums)
+
+    if home is None and places:
+        home = max(places, key=lambda place: places[place]['sessions'])
+    elif home is not None:
+        home = home[:precision]
+
+    def is_home(place):
+        return home is not None and place.startswith(home)
+
+    home_sums, away_sums = new_cell(), new_cell()
+    for place, sums in places.items():
+        add_cell(home_sums if is_home(place) else away_sums, sums)
+
+    return {
+        'precision': precision,
+        'years': years,
+        'home': home,
+        'home_vs_away': {
+            'home': describe(home, home_sums) if home_sums['sessions'] else None,
+            'away': describe('away', away_sums) if away_sums['sessions'] else None,
+        },
+        'places': [
+            dict(describe(place, sums), home=is_home(place))
+            for place, sums in sorted(places.items(), key=lambda item: -item[1]['sessions'])
+        ],
+        'unknown': describe(None, unknown) if unknown['sessions'] else None,
+    }
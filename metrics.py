@@ -0,0 +1,132 @@
+# =-=-=-=-==-=-=
+# Server Metrics
+# =-=-=-=-==-=-=
+#
+# In-process counters and latency histograms for the upload pipeline, exposed
+# by the server at /metrics in the Prometheus text format. Nothing here talks
+# to the network; Prometheus (or curl) scrapes the endpoint.
+#
+#   with metrics.span('import'):    times a stage into sleep_stage_seconds
+#   metrics.inc('records_parsed', n)
+#
+# Code running in the process pool can't record into the server's metrics;
+# parse_zip_data hands its extract/parse timings back for the server to record.
+#
+# Setting PROFILE_SLOW_UPLOAD_SECONDS profiles every upload job with cProfile
+# and keeps a .pstats file in PROFILE_DIR for the ones slower than that
+# (view with python -m pstats <file>). It profiles the event loop thread, so
+# anything else the server does meanwhile shows up in it too.
+
+import cProfile
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+PREFIX = 'sleep_'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+PROFILE_SLOW_UPLOAD_SECONDS = float(os.getenv('PROFILE_SLOW_UPLOAD_SECONDS', '0')) or None
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+
+HELP = {
+    'bytes_received': "Bytes of upload bodies received",
+    'records_parsed': "Records parsed from uploaded exports",
+    'records_inserted': "Records newly inserted into the database",
+    'records_skipped': "Records in uploaded exports that were already imported",
+    'records_exported': "Records streamed out by /export",
+    'uploads': "Uploads by outcome",
+    'discord_messages': "Discord webhook messages by outcome",
+    'stage_seconds': "Time spent per pipeline stage",
+}
+
+# name -> {labels: value}, labels being a sorted tuple of (key, value)
+counters = defaultdict(lambda: defaultdict(float))
+# name -> {labels: [bucket counts..., sum, count]}
+histograms = defaultdict(dict)
+_profiling = False
+
+
+def inc(name, value=1, **labels):
+    counters[name][tuple(sorted(labels.items()))] += value
+
+
+def observe(name, value, **labels):
+    key = tuple(sorted(labels.items()))
+    series = histograms[name].setdefault(key, [0] * len(BUCKETS) + [0.0, 0])
+    for index, bound in enumerate(BUCKETS):
+        if value <= bound:
+            series[index] += 1
+    series[-2] += value
+    series[-1] += 1
+
+
+@contextmanager
+def span(stage):
+    # Times the block into sleep_stage_seconds{stage=...}. The yielded dict
+    # has the start time and gets the duration under 'seconds' once it's done.
+    timing = {'start': time.perf_counter()}
+    try:
+        yield timing
+    finally:
+        timing['seconds'] = time.perf_counter() - timing['start']
+        observe('stage_seconds', timing['seconds'], stage=stage)
+
+
+@contextmanager
+def profile_if_slow(name, threshold=PROFILE_SLOW_UPLOAD_SECONDS):
+    # Profiles the block and dumps the stats to PROFILE_DIR/<name>.pstats if
+    # it took longer than threshold. Only one block is profiled at a time.
+    global _profiling
+    if threshold is None or _profiling:
+        yield
+        return
+
+    _profiling = True
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _profiling = False
+        elapsed = time.perf_counter() - start
+        if elapsed > threshold:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f"{name}.pstats")
+            profiler.dump_stats(path)
+            print(f"{name} took {elapsed:.3f}s, profile written to {path}")
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render():
+    # Everything in the Prometheus text exposition format
+    lines = []
+    for name, series in sorted(counters.items()):
+        metric = f"{PREFIX}{name}_total"
+        lines.append(f"# HELP {metric} {HELP.get(name, name)}")
+        lines.append(f"# TYPE {metric} counter")
+        for labels, value in sorted(series.items()):
+            lines.append(f"{metric}{format_labels(labels)} {format_value(value)}")
+
+    for name, series in sorted(histograms.items()):
+        metric = f"{PREFIX}{name}"
+        lines.append(f"# HELP {metric} {HELP.get(name, name)}")
+        lines.append(f"# TYPE {metric} histogram")
+        for labels, values in sorted(series.items()):
+            for bound, count in zip(BUCKETS, values):
+                lines.append(f"{metric}_bucket{format_labels(labels, [('le', f'{bound:g}')])} {count}")
+            lines.append(f"{metric}_bucket{format_labels(labels, [('le', '+Inf')])} {values[-1]}")
+            lines.append(f"{metric}_sum{format_labels(labels)} {format_value(values[-2])}")
+            lines.append(f"{metric}_count{format_labels(labels)} {values[-1]}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,191 @@
+# =-=-=-=-==-=-=-=-=
+# Online Sleep Stats
+# =-=-=-=-==-=-=-=-=
+#
+# Long-horizon statistics kept up to date as records are imported, instead of
+# being recomputed from the whole history for every report. Each user has one
+# small JSON state (table sleep_online_stats) that import_to_database folds
+# every newly inserted record into, in O(1) per record:
+#
+#   sessions / deep   Welford running mean and variance of the session length
+#                     (hours) and of the deep sleep fraction
+#   histograms        session lengths in HISTOGRAM_BIN_MINUTES bins, one
+#                     histogram per year, for percentiles ("90th percentile
+#                     night this year") accurate to a bin
+#   ewma              exponentially weighted averages of each night's total
+#                     sleep and deep sleep over EWMA_DAYS time constants,
+#                     weighted by the days between nights, so a 7-day average
+#                     can be compared to a 90-day baseline
+#
+# A night is the local day its sessions ended on (like sleep_daily). The
+# latest night stays open in 'night' while more sessions for it may come, and
+# is folded into the averages once a later night arrives.
+#
+# Welford and the histograms don't depend on the order records come in. The
+# averages do: sessions from before the open night (a backfill of older
+# exports) still count for the rest, but are left out of the averages.
+# `import_to_db.py --rebuild-online-stats` recomputes every state from
+# sleep_records in order, and states from an older STATE_VERSION are rebuilt
+# when the database is set up.
+
+import json
+import math
+from datetime import date, datetime, timezone
+
+STATE_VERSION = 2
+HISTOGRAM_BIN_MINUTES = 5
+HISTOGRAM_BINS = 16 * 60 // HISTOGRAM_BIN_MINUTES
+EWMA_DAYS = (7, 90)
+
+
+def new_state():
+    return {
+        'version': STATE_VERSION,
+        'sessions': {'count': 0, 'mean': 0.0, 'm2': 0.0},
+        'deep': {'count': 0, 'mean': 0.0, 'm2': 0.0},
+        'histograms': {},
+        'night': None,
+        'ewma': None,
+    }
+
+
+def load(data):
+    # Persisted JSON -> state, a new one if there is none or it is outdated
+    state = json.loads(data) if data else None
+    if state is None or state.get('version') != STATE_VERSION:
+        return new_state()
+    return state
+
+
+def dump(state):
+    return json.dumps(state, separators=(',', ':'))
+
+
+def welford(accumulator, value):
+    accumulator['count'] += 1
+    delta = value - accumulator['mean']
+    accumulator['mean'] += delta / accumulator['count']
+    accumulator['m2'] += delta * (value - accumulator['mean'])
+
+
+def night_of(record):
+    # The local day a record's session ended on. Rows read back from the
+    # database carry it as 'day' (their end_time is in UTC by then).
+    day = record.get('day')
+    if day is None:
+        return record['end_time'].date()
+    return date.fromisoformat(day) if isinstance(day, str) else day
+
+
+def fold_night(ewma, night):
+    # Folds a finished night into the averages (a new dict, ewma isn't changed)
+    day = date.fromisoformat(night['day'])
+    if ewma is None:
+        values = {f"{name}_{days}": night[name] for name in ('sleep', 'deep') for days in EWMA_DAYS}
+        return dict(values, day=night['day'])
+
+    elapsed = (day - date.fromisoformat(ewma['day'])).days
+    folded = dict(ewma, day=night['day'])
+    for days in EWMA_DAYS:
+        weight = 1 - math.exp(-elapsed / days)
+        for name in ('sleep', 'deep'):
+            key = f"{name}_{days}"
+            folded[key] += weight * (night[name] - folded[key])
+    return folded
+
+
+def update(state, records):
+    # Folds newly inserted records into state, in place, and returns it
+    for record in sorted(records, key=lambda record: (night_of(record), record['end_time'])):
+        hours = record['sleep_duration'] or 0.0
+        deep_fraction = record['deep_sleep'] if record['deep_sleep'] is not None and record['deep_sleep'] >= 0 else None
+        day = night_of(record)
+
+        welford(state['sessions'], hours)
+        if deep_fraction is not None:
+            welford(state['deep'], deep_fraction)
+
+        counts = state['histograms'].setdefault(str(day.year), [0] * HISTOGRAM_BINS)
+        # Clamped at both ends: a negative length (a LenAdjust larger than the
+        # session) would otherwise index from the end of the list
+        counts[max(0, min(int(hours * 60 // HISTOGRAM_BIN_MINUTES), HISTOGRAM_BINS - 1))] += 1
+
+        deep_hours = hours * deep_fraction if deep_fraction is not None else 0.0
+        night = state['night']
+        if night is None or day.isoformat() > night['day']:
+            if night is not None:
+                state['ewma'] = fold_night(state['ewma'], night)
+            state['night'] = {'day': day.isoformat(), 'sleep': hours, 'deep': deep_hours}
+        elif day.isoformat() == night['day']:
+            night['sleep'] += hours
+            night['deep'] += deep_hours
+        # Older nights only count for the order-independent stats, see above
+    return state
+
+
+def percentile(counts, q):
+    # q-th percentile (0-100) in hours from histogram counts, interpolated
+    # within the bin it falls in
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q / 100 * total
+    seen = 0
+    for index, count in enumerate(counts):
+        if count and seen + count >= rank:
+            return (index + (rank - seen) / count) * HISTOGRAM_BIN_MINUTES / 60
+        seen += count
+    return len(counts) * HISTOGRAM_BIN_MINUTES / 60
+
+
+def summary(state, now=None):
+    # The numbers worth reporting, all read straight from the state
+    now = now or datetime.now(timezone.utc)
+    sessions = state['sessions']
+    if not sessions['count']:
+        return None
+
+    year = state['histograms'].get(str(now.year))
+    all_time = [sum(counts) for counts in zip(*state['histograms'].values())]
+    ewma = state['ewma']
+    if state['night'] is not None:
+        ewma = fold_night(ewma, state['night'])
+    short, baseline = EWMA_DAYS
+
+    return {
+        'sessions': sessions['count'],
+        'mean_hours': sessions['mean'],
+        'stddev_hours': math.sqrt(sessions['m2'] / (sessions['count'] - 1)) if sessions['count'] > 1 else 0.0,
+        'mean_deep_fraction': state['deep']['mean'] if state['deep']['count'] else None,
+        'p10_hours_this_year': percentile(year, 10) if year else None,
+        'p90_hours_this_year': percentile(year, 90) if year else None,
+        'median_hours': percentile(all_time, 50),
+        'p90_hours': percentile(all_time, 90),
+        'ewma_days': [short, baseline],
+        'sleep_ewma': ewma[f"sleep_{short}"],
+        'sleep_baseline': ewma[f"sleep_{baseline}"],
+        'deep_ewma': ewma[f"deep_{short}"],
+        'deep_baseline': ewma[f"deep_{baseline}"],
+    }
+
+
+def format_hours(hours):
+    whole, minutes = divmod(round(hours * 60), 60)
+    return f"{whole}h {minutes:02d}m"
+
+
+def format_summary(stats):
+    # A Discord embed field, like import_to_db.format_sleep_record's
+    short, baseline = stats['ewma_days']
+    difference = stats['sleep_ewma'] - stats['sleep_baseline']
+    value = (f"😴 {short}d avg {format_hours(stats['sleep_ewma'])} a night vs {baseline}d "
+             f"{format_hours(stats['sleep_baseline'])} ({'+' if difference >= 0 else '-'}"
+             f"{format_hours(abs(difference))})\n"
+             f"💤 Deep sleep {short}d avg {format_hours(stats['deep_ewma'])} vs "
+             f"{format_hours(stats['deep_baseline'])}\n")
+    if stats['p90_hours_this_year'] is not None:
+        value += (f"📊 This year: 10% of sessions under {format_hours(stats['p10_hours_this_year'])}, "
+                  f"10% over {format_hours(stats['p90_hours_this_year'])}\n")
+    value += (f"📈 All time: {stats['sessions']} sessions, {format_hours(stats['mean_hours'])} "
+              f"± {format_hours(stats['stddev_hours'])}, median {format_hours(stats['median_hours'])}\n")
+    return {"name": "📈 Trends", "value": value}
@@ -0,0 +1,200 @@
+# =-=-=-=-==-=-=-=-=-=-=-=-=
+# Columnar Sleep Data Loader
+# =-=-=-=-==-=-=-=-=-=-=-=-=
+#
+# Reads a Sleep as Android CSV export (alternating header/value rows) in one
+# pass and returns the fixed fields as NumPy arrays instead of one dict per
+# record:
+#
+#   id          int64    the record Id (start time in ms since the epoch)
+#   start       int64    start time, seconds since the epoch (from Id)
+#   end         int64    end time, seconds since the epoch (from To + Tz)
+#   utc_offset  int32    the end time's UTC offset in seconds
+#   hours       float64  Hours
+#   deep_sleep  float64  DeepSleep (-1/-2 when not available)
+#   len_adjust  float64  LenAdjust (negative minutes awake, -1 when manual)
+#   cycles      int16    Cycles (-1 when not available)
+#   tz / geo    int16/int32 codes into tz_names / geo_names
+#   comment     list of the raw Comment strings
+#   actigraphy / events  (with_actigraphy=True) per-record arrays, see actigraphy.py
+#
+# Wall-clock times are parsed with integer arithmetic on the character codes
+# of the whole column at once. UTC offsets come from tzcache, the resolver the
+# dict parsers use too, looked up once per distinct zone and local minute.
+# utc_offset keeps them, so the local end time is end + utc_offset.
+# Both import_to_db.py and analysis.py can load exports through this.
+
+import csv
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+
+import numpy as np
+
+import tzcache
+from actigraphy import parse_actigraphy
+
+FIELDS = ['Id', 'Tz', 'To', 'Hours', 'DeepSleep', 'LenAdjust', 'Cycles', 'Geo', 'Comment']
+TIME_FORMAT = '%d. %m. %Y %H:%M'
+# 'dd. mm. yyyy HH:MM'
+TIME_WIDTH = 18
+EPOCH = datetime(1970, 1, 1)
+
+
+def read_raw_columns(csv_file, since_ms=None, with_actigraphy=False, info=None):
+    # Collects the raw strings of the fixed fields, one list per field.
+    # Records with an Id at or below since_ms are dropped right here (and
+    # counted in info['records_skipped'] if an info dict is given).
+    raw = {field: [] for field in FIELDS}
+    columns = [raw[field] for field in FIELDS]
+    raw['actigraphy'] = []
+    raw['events'] = []
+    positions = {}
+    skipped = 0
+
+    csv_reader = csv.reader(csv_file)
+    while True:
+        try:
+            header = next(csv_reader)
+            values = next(csv_reader)
+        except StopIteration:
+            break
+
+        # The fixed fields always come first, so the header prefix is a
+        # cheap cache key even though the actigraphy columns vary per record
+        key = tuple(header[:15])
+        indices = positions.get(key)
+        if indices is None:
+            indices = positions[key] = [header.index(field) for field in FIELDS]
+
+        if since_ms is not None and int(values[indices[0]]) <= since_ms:
+            skipped += 1
+            continue
+        for column, index in zip(columns, indices):
+            column.append(values[index])
+        if with_actigraphy:
+            samples, events = parse_actigraphy(header, values)
+            raw['actigraphy'].append(samples)
+            raw['events'].append(events)
+
+    if info is not None:
+        info['records_skipped'] = skipped
+    return raw
+
+
+def days_from_civil(year, month, day):
+    # Days since 1970-01-01 for proleptic Gregorian dates, on whole arrays
+    # (Howard Hinnant's days_from_civil)
+    year = year - (month <= 2)
+    era = np.floor_divide(year, 400)
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def parse_local_times(strings):
+    # 'dd. mm. yyyy HH:MM' strings to naive wall-clock seconds since the epoch
+    strings = np.asarray(strings, dtype=str)
+    result = np.empty(len(strings), dtype=np.int64)
+    if len(strings) == 0:
+        return result
+
+    fixed = np.char.str_len(strings) == TIME_WIDTH
+    if fixed.any():
+        codes = strings[fixed].astype(f'U{TIME_WIDTH}').view(np.uint32)
+        digits = codes.reshape(-1, TIME_WIDTH).astype(np.int64) - ord('0')
+        day = digits[:, 0] * 10 + digits[:, 1]
+        month = digits[:, 4] * 10 + digits[:, 5]
+        year = digits[:, 8] * 1000 + digits[:, 9] * 100 + digits[:, 10] * 10 + digits[:, 11]
+        hour = digits[:, 13] * 10 + digits[:, 14]
+        minute = digits[:, 16] * 10 + digits[:, 17]
+        result[fixed] = days_from_civil(year, month, day) * 86400 + hour * 3600 + minute * 60
+
+    # Anything that isn't zero padded goes through strptime
+    for index in np.flatnonzero(~fixed):
+        parsed = datetime.strptime(strings[index], TIME_FORMAT)
+        result[index] = (parsed - EPOCH) // timedelta(seconds=1)
+    return result
+
+
+def utc_offsets(tz_name, local_seconds):
+    # UTC offsets (in seconds) for naive wall-clock times in tz_name, from
+    # tzcache like the dict parsers' (one lookup per distinct local minute)
+    minutes, inverse = np.unique(local_seconds // 60, return_inverse=True)
+    offsets = np.array([tzcache.utc_offset_seconds(tz_name, minute) for minute in minutes.tolist()],
+                       dtype=np.int64)
+    return offsets[inverse.reshape(-1)]
+
+
+def categorize(strings):
+    names, codes = np.unique(np.asarray(strings, dtype=str), return_inverse=True)
+    return names.tolist(), codes.reshape(-1)
+
+
+def load_sleep_columns(csv_file, since_ms=None, with_actigraphy=False, info=None):
+    if isinstance(csv_file, str):
+        with open(csv_file, 'r', encoding='utf-8', newline='') as file:
+            return load_sleep_columns(file, since_ms, with_actigraphy, info)
+
+    raw = read_raw_columns(csv_file, since_ms, with_actigraphy, info)
+
+    ids = np.array(raw['Id'], dtype=np.int64)
+    tz_names, tz_codes = categorize(raw['Tz'])
+    geo_names, geo_codes = categorize(raw['Geo'])
+
+    end = parse_local_times(raw['To'])
+    offsets = np.zeros(len(end), dtype=np.int64)
+    for code, tz_name in enumerate(tz_names):
+        rows = tz_codes == code
+        offsets[rows] = utc_offsets(tz_name, end[rows])
+    end -= offsets
+
+    return {
+        'id': ids,
+        'start': ids // 1000,
+        'end': end,
+        'utc_offset': offsets.astype(np.int32),
+        # float64, so each value is exactly float() of the export's decimal,
+        # like process_sleep_data stores it
+        'hours': np.array(raw['Hours'], dtype=np.float64),
+        'deep_sleep': np.array(raw['DeepSleep'], dtype=np.float64),
+        'len_adjust': np.array(raw['LenAdjust'], dtype=np.float64),
+        'cycles': np.array(raw['Cycles'], dtype=np.int16),
+        'tz': tz_codes.astype(np.int16),
+        'tz_names': tz_names,
+        'geo': geo_codes.astype(np.int32),
+        'geo_names': geo_names,
+        'comment': raw['Comment'],
+        'actigraphy': raw['actigraphy'],
+        'events': raw['events'],
+    }
+
+
+def iter_records(columns):
+    # Yields dicts shaped like import_to_db.parse_sleep_record's output, for
+    # code that still wants one record at a time
+    hours = columns['hours'].tolist()
+    deep_sleep = columns['deep_sleep'].tolist()
+    len_adjust = columns['len_adjust'].tolist()
+    ends = columns['end'].tolist()
+    offsets = columns['utc_offset'].tolist()
+    with_actigraphy = len(columns['actigraphy']) == len(columns['id'])
+
+    for index in range(len(columns['id'])):
+        cycles = int(columns['cycles'][index])
+
+        record = {
+            'start_time': datetime.fromtimestamp(int(columns['id'][index]) / 1000, dt_timezone.utc),
+            'end_time': datetime.fromtimestamp(ends[index], tzcache.fixed_offset(offsets[index])),
+            'sleep_duration': hours[index] + (len_adjust[index] / 60) if len_adjust[index] != -1.0 else hours[index],
+            'cycles': cycles if cycles != -1 else None,
+            'deep_sleep': deep_sleep[index] if deep_sleep[index] not in (-1.0, -2.0) else None,
+            'time_awake': abs(int(len_adjust[index])) if len_adjust[index] != -1.0 else None,
+            'location_hash': columns['geo_names'][columns['geo'][index]],
+            'comment': columns['comment'][index],
+            'tz': columns['tz_names'][columns['tz'][index]],
+        }
+        if with_actigraphy:
+            record['actigraphy'] = columns['actigraphy'][index]
+            record['events'] = columns['events'][index]
+        yield record
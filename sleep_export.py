@@ -0,0 +1,206 @@
+# =-=-=-=-==-=-=-=-=
+# Sleep Data Export
+# =-=-=-=-==-=-=-=-=
+#
+# Streams a user's sleep_records back out, for GET /export:
+#
+#   /export?format=csv|arrow|parquet&from=2020-01-01&to=2024-01-01
+#
+# Rows are read from a server-side cursor EXPORT_BATCH_SIZE at a time, and
+# every batch is encoded and written to the (chunked) response before the
+# next one is fetched, so memory stays flat however much history there is.
+#
+#   csv       one header line, timestamps in ISO 8601
+#   arrow     Arrow IPC stream, one record batch per fetched batch
+#   parquet   one row group per fetched batch
+#
+# Arrow and Parquet need pyarrow, the optional 'export' extra (poetry install
+# --extras export, as the Docker image does). It is only imported when one of
+# them is asked for.
+
+import csv
+import io
+import os
+import time
+from datetime import datetime, timezone
+
+import metrics
+
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '10000'))
+
+# Column, Arrow type
+EXPORT_COLUMNS = [
+    ('start_time', 'timestamp'),
+    ('end_time', 'timestamp'),
+    ('sleep_duration', 'float64'),
+    ('cycles', 'int32'),
+    ('deep_sleep', 'float64'),
+    ('time_awake', 'int32'),
+    ('location_hash', 'string'),
+    ('comment', 'string'),
+    ('tz', 'string'),
+]
+
+EXPORT_QUERY = f"""
+    SELECT {', '.join(column for column, _ in EXPORT_COLUMNS)}
+    FROM sleep_records
+    WHERE user_id = $1 AND start_time >= $2 AND start_time < $3
+    ORDER BY start_time
+"""
+
+# format -> content type, file extension
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+EARLIEST = datetime(1, 1, 1, tzinfo=timezone.utc)
+LATEST = datetime(9999, 12, 31, tzinfo=timezone.utc)
+
+
+def load_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def available_formats():
+    return [name for name in FORMATS if name == 'csv' or load_pyarrow() is not None]
+
+
+def parse_time(value, default):
+    # '2024-01-01' or an ISO 8601 timestamp; naive ones are taken as UTC
+    if not value:
+        return default
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def parse_export_query(query):
+    # ?format=&from=&to= -> (format, from, to); raises ValueError
+    export_format = query.get('format', 'csv').lower()
+    if export_format not in FORMATS:
+        raise ValueError(f"Unknown format {export_format!r}, use one of {', '.join(FORMATS)}")
+    if export_format not in available_formats():
+        raise ValueError(f"Format {export_format} needs pyarrow, which isn't installed")
+    time_from = parse_time(query.get('from'), EARLIEST)
+    time_to = parse_time(query.get('to'), LATEST)
+    if time_from >= time_to:
+        raise ValueError("from must be before to")
+    return export_format, time_from, time_to
+
+
+class CsvEncoder:
+    def __init__(self):
+        self.header = True
+
+    def encode(self, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if self.header:
+            writer.writerow(column for column, _ in EXPORT_COLUMNS)
+            self.header = False
+        for row in rows:
+            writer.writerow(value.isoformat() if isinstance(value, datetime) else value for value in row)
+        return buffer.getvalue().encode()
+
+    def finish(self):
+        # Just the header when there were no records
+        return self.encode([]) if self.header else b''
+
+
+class ChunkSink:
+    # Write-only file object for pyarrow; take() hands over what was written
+    # since the last call
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+class ArrowEncoder:
+    # Arrow IPC stream or Parquet file, one batch / row group per encode()
+    def __init__(self, export_format):
+        self.pa = load_pyarrow()
+        types = {
+            'timestamp': self.pa.timestamp('us', tz='UTC'),
+            'float64': self.pa.float64(),
+            'int32': self.pa.int32(),
+            'string': self.pa.string(),
+        }
+        self.schema = self.pa.schema([(column, types[kind]) for column, kind in EXPORT_COLUMNS])
+        self.sink = ChunkSink()
+        if export_format == 'parquet':
+            self.writer = self.pa.parquet.ParquetWriter(self.sink, self.schema, compression='zstd')
+        else:
+            self.writer = self.pa.ipc.new_stream(self.sink, self.schema)
+
+    def encode(self, rows):
+        columns = list(zip(*rows))
+        batch = self.pa.record_batch(
+            [self.pa.array(values, type=field.type) for values, field in zip(columns, self.schema)],
+            schema=self.schema
+        )
+        self.writer.write_batch(batch)
+        return self.sink.take()
+
+    def finish(self):
+        self.writer.close()
+        return self.sink.take()
+
+
+def make_encoder(export_format):
+    return CsvEncoder() if export_format == 'csv' else ArrowEncoder(export_format)
+
+
+async def stream_export(pool, write, user_id, export_format, time_from=EARLIEST, time_to=LATEST,
+                        batch_size=EXPORT_BATCH_SIZE):
+    # Fetches the user's records in [time_from, time_to) batch by batch and
+    # awaits write(chunk) for each encoded one. Returns (rows, bytes).
+    encoder = make_encoder(export_format)
+    rows = written = 0
+    with metrics.span('export') as timing:
+        async with pool.acquire() as conn:
+            # Server-side cursors only live inside a transaction
+            async with conn.transaction(readonly=True):
+                cursor = await conn.cursor(EXPORT_QUERY, user_id, time_from, time_to)
+                while batch := await cursor.fetch(batch_size):
+                    chunk = encoder.encode(batch)
+                    rows += len(batch)
+                    if chunk:
+                        written += len(chunk)
+                        await write(chunk)
+        chunk = encoder.finish()
+        if chunk:
+            written += len(chunk)
+            await write(chunk)
+
+    seconds = time.perf_counter() - timing['start']
+    metrics.inc('records_exported', rows, format=export_format)
+    print(f"Exported {rows} records for {user_id} as {export_format} ({written / 1024**2:.1f} MiB) "
+          f"in {seconds:.2f}s ({rows / seconds:.0f} records/sec, {written / 1024**2 / seconds:.1f} MiB/sec)")
+    return rows, written
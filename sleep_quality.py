@@ -0,0 +1,143 @@
+# =-=-=-=-==-=-=-=-=-=
+# Sleep Quality Engine
+# =-=-=-=-==-=-=-=-=-=
+#
+# Movement-based sleep quality metrics computed from the raw per-night
+# actigraphy series (see actigraphy.py), so nights get a quality picture even
+# when the app didn't provide DeepSleep/LenAdjust (e.g. manually added ones).
+#
+# All nights are padded into one (nights x samples) matrix and every metric
+# is a handful of 2-D NumPy operations over it, no per-sample Python loops:
+#
+#   1. each epoch's activity is smoothed with a small weighted window
+#      (Cole-Kripke style) and scored as wake when it's well above that
+#      night's median movement
+#   2. sleep efficiency       share of epochs scored as sleep
+#   3. fragmentation index    sleep -> wake transitions per hour asleep
+#   4. longest stretch        longest run of consecutive sleep epochs
+#   5. estimated cycles       rises of the ~1h smoothed activity above the
+#                             night's median; movement bursts mark the lighter
+#                             phase between deep sleep, so each one closes a
+#                             cycle
+
+import warnings
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Weights for the epochs around the scored one (centre is the scored epoch)
+SCORING_WEIGHTS = np.array([1, 1, 2, 4, 2, 1, 1], dtype=np.float32)
+# An epoch is wake when its smoothed activity exceeds this many times the
+# night's median smoothed activity (and is above the floor)
+WAKE_FACTOR = 2.5
+WAKE_FLOOR = 0.05
+CYCLE_SMOOTHING_MINUTES = 60
+
+
+def pad_nights(series_list):
+    # Stacks 1-D series of different lengths into a NaN padded matrix
+    lengths = np.array([len(series) for series in series_list], dtype=np.int64)
+    # At least one column so empty batches still go through the windows
+    width = max(1, int(lengths.max()) if len(lengths) else 0)
+    matrix = np.full((len(series_list), width), np.nan, dtype=np.float32)
+    valid = np.arange(width) < lengths[:, None]
+    if lengths.sum():
+        matrix[valid] = np.concatenate([np.asarray(series, dtype=np.float32) for series in series_list])
+    return matrix, valid
+
+
+def moving_average(matrix, valid, window):
+    # Centred moving average along each row, ignoring padding/NaN samples
+    half = window // 2
+    values = np.where(valid, np.nan_to_num(matrix), 0.0)
+    padded = np.pad(values, ((0, 0), (half, window - 1 - half)))
+    counts = np.pad(valid.astype(np.float32), ((0, 0), (half, window - 1 - half)))
+    sums = sliding_window_view(padded, window, axis=1).sum(axis=2)
+    weights = sliding_window_view(counts, window, axis=1).sum(axis=2)
+    return np.divide(sums, weights, out=np.zeros_like(sums), where=weights > 0)
+
+
+def score_sleep_wake(matrix, valid):
+    # True where an epoch is scored as wake
+    half = len(SCORING_WEIGHTS) // 2
+    values = np.pad(np.where(valid, np.nan_to_num(matrix), 0.0), ((0, 0), (half, half)))
+    smoothed = sliding_window_view(values, len(SCORING_WEIGHTS), axis=1) @ SCORING_WEIGHTS
+    smoothed /= SCORING_WEIGHTS.sum()
+
+    median = row_median(smoothed, valid)
+    threshold = np.maximum(median * WAKE_FACTOR, WAKE_FLOOR)
+    return valid & (smoothed > threshold)
+
+
+def row_median(matrix, valid):
+    # Median of the valid entries of each row (0 for rows without any)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        median = np.nanmedian(np.where(valid, matrix, np.nan), axis=1, keepdims=True)
+    return np.nan_to_num(median)
+
+
+def longest_run(flags):
+    # Length of the longest run of True values in each row
+    columns = np.arange(flags.shape[1])
+    last_break = np.maximum.accumulate(np.where(flags, -1, columns), axis=1)
+    runs = np.where(flags, columns - last_break, 0)
+    return runs.max(axis=1) if flags.shape[1] else np.zeros(len(flags), dtype=np.int64)
+
+
+def analyze_quality(series_list, durations_minutes):
+    """
+    Quality metrics for a batch of nights.
+
+    series_list: per-night actigraphy arrays
+    durations_minutes: per-night tracked duration, used for the epoch length
+
+    Returns a dict of arrays, one value per night (NaN for nights without
+    any actigraphy).
+    """
+    matrix, valid = pad_nights(series_list)
+    lengths = valid.sum(axis=1)
+    durations = np.asarray(durations_minutes, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        epoch_minutes = np.where(lengths > 0, durations / lengths, np.nan)
+
+    wake = score_sleep_wake(matrix, valid)
+    sleep = valid & ~wake
+    sleep_epochs = sleep.sum(axis=1)
+    sleep_hours = sleep_epochs * epoch_minutes / 60
+    # sleep -> wake transitions
+    awakenings = (sleep[:, :-1] & wake[:, 1:]).sum(axis=1)
+
+    # Cycles: times the ~1h smoothed activity rises above the night's median
+    typical_epoch = np.nanmedian(epoch_minutes) if np.isfinite(epoch_minutes).any() else 1.0
+    window = max(3, int(round(CYCLE_SMOOTHING_MINUTES / typical_epoch)))
+    trend = moving_average(matrix, valid, window)
+    above = valid & (trend > row_median(trend, valid))
+    rises = (~above[:, :-1] & above[:, 1:]).sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'sleep_efficiency': np.where(lengths > 0, sleep_epochs / lengths * 100, np.nan),
+            'wake_minutes': np.where(lengths > 0, wake.sum(axis=1) * epoch_minutes, np.nan),
+            'fragmentation_index': np.where(sleep_hours > 0, awakenings / sleep_hours, np.nan),
+            'longest_sleep_minutes': np.where(lengths > 0, longest_run(sleep) * epoch_minutes, np.nan),
+            'estimated_cycles': np.where(lengths > 0, rises + 1, np.nan),
+        }
+
+
+def analyze_records(records):
+    # Runs analyze_quality over records carrying 'actigraphy' and start/end
+    # times, and returns one metrics dict per record (None without data)
+    series = [record.get('actigraphy', ()) for record in records]
+    durations = [(record['end_time'] - record['start_time']).total_seconds() / 60 for record in records]
+    if not records:
+        return []
+
+    metrics = analyze_quality(series, durations)
+    results = []
+    for index, samples in enumerate(series):
+        if len(samples) == 0:
+            results.append(None)
+        else:
+            results.append({name: float(values[index]) for name, values in metrics.items()})
+    return results
@@ -0,0 +1,103 @@
+# =-=-=-=-==-=-=-=-=
+# Sleep Stats Queries
+# =-=-=-=-==-=-=-=-=
+#
+# Reporting queries that run inside PostgreSQL against sleep_records, so the
+# upload server can answer stats requests with one indexed query instead of
+# re-extracting and re-parsing the export like analysis.py does.
+#
+# The numbers match analysis.analyze_sleep_data: a record's sleep is its
+# start..end span minus the minutes spent awake, spread evenly over the span,
+# and records straddling a window boundary only count for the part inside it.
+#
+# Per-day questions (least sleep in a night, daily series) read the small
+# sleep_daily rollup that import_to_db.py maintains instead of raw records.
+#
+# Everything is per user; filtering on user_id keeps the window query on that
+# user's sleep_records partition.
+
+from datetime import datetime, timezone
+
+import users
+
+WINDOW_STATS_QUERY = """
+    SELECT w.days,
+           COALESCE(SUM(
+               (EXTRACT(EPOCH FROM r.end_time - r.start_time) - COALESCE(r.time_awake, 0) * 60)
+               * EXTRACT(EPOCH FROM LEAST(r.end_time, $2::timestamptz) - GREATEST(r.start_time, $2::timestamptz - make_interval(days => w.days)))
+               / EXTRACT(EPOCH FROM r.end_time - r.start_time)
+           ), 0)::float8 AS sleep_seconds
+    FROM unnest($1::int[]) AS w(days)
+    LEFT JOIN sleep_records r
+        ON r.user_id = $3
+        AND r.end_time > $2::timestamptz - make_interval(days => w.days)
+        AND r.start_time < $2::timestamptz
+        AND r.end_time > r.start_time
+    GROUP BY w.days
+    ORDER BY w.days
+"""
+
+
+LEAST_SLEEP_QUERY = """
+    SELECT DISTINCT ON (w.days) w.days, d.day, d.total_sleep_minutes
+    FROM unnest($1::int[]) AS w(days)
+    JOIN sleep_daily d
+        ON d.user_id = $3
+        AND d.day > $2::date - w.days
+        AND d.day <= $2::date
+    ORDER BY w.days, d.total_sleep_minutes
+"""
+
+DAILY_QUERY = """
+    SELECT day, total_sleep_minutes, record_count, min_session_minutes,
+           max_session_minutes, deep_sleep_minutes, awake_minutes
+    FROM sleep_daily
+    WHERE user_id = $3 AND day > $2::date - $1::int AND day <= $2::date
+    ORDER BY day
+"""
+
+
+def parse_windows(value, default=(1, 3, 7), max_days=36500):
+    # '1,3,7,30' -> [1, 3, 7, 30]
+    if not value:
+        return list(default)
+    windows = sorted({int(part) for part in value.split(',') if part.strip()})
+    if not windows or windows[0] < 1 or windows[-1] > max_days:
+        raise ValueError(f"Windows must be between 1 and {max_days} days")
+    return windows
+
+
+async def fetch_window_stats(conn, windows, now=None, user_id=users.DEFAULT_USER):
+    # conn can be a connection or a pool
+    now = now or datetime.now(timezone.utc)
+    rows = await conn.fetch(WINDOW_STATS_QUERY, list(windows), now, user_id)
+    return {row['days']: window_stats(row['days'], row['sleep_seconds']) for row in rows}
+
+
+def window_stats(days, sleep_seconds):
+    # The numbers reported for a window, from the seconds slept in it
+    total_seconds = days * 86400
+    sleep_hours = sleep_seconds / 3600
+    return {
+        'sleep_seconds': sleep_seconds,
+        'sleep_ratio': sleep_seconds / total_seconds * 100,
+        'awake_ratio': (total_seconds - sleep_seconds) / total_seconds * 100,
+        'avg_24h_asleep_hours': sleep_hours / days,
+        'avg_24h_awake_hours': 24 - sleep_hours / days,
+    }
+
+
+async def fetch_least_sleep_nights(conn, windows, now=None, user_id=users.DEFAULT_USER):
+    # The day with the least total sleep within each window, if any
+    now = now or datetime.now(timezone.utc)
+    rows = await conn.fetch(LEAST_SLEEP_QUERY, list(windows), now.date(), user_id)
+    return {
+        row['days']: {'day': row['day'].isoformat(), 'total_sleep_minutes': row['total_sleep_minutes']}
+        for row in rows
+    }
+
+
+async def fetch_daily(conn, days, now=None, user_id=users.DEFAULT_USER):
+    now = now or datetime.now(timezone.utc)
+    rows = await conn.fetch(DAILY_QUERY, days, now.date(), user_id)
+    return [dict(row, day=row['day'].isoformat()) for row in rows]
@@ -0,0 +1,291 @@
+# =-=-=-=-==-=-=-=
+# Embedded Storage
+# =-=-=-=-==-=-=-=
+#
+# A single-file SQLite backend, for importing and reporting on a laptop
+# without a Postgres server:
+#
+#   python import_to_db.py --sqlite sleep.db          (or DB_BACKEND=sqlite)
+#   python analysis.py --sqlite sleep.db --windows 1,7,30
+#
+# import_to_db.py switches setup_database, import_to_database and the
+# high-water mark over to this module when DB_BACKEND is 'sqlite' (the file
+# is SQLITE_PATH). The upload server always uses Postgres.
+#
+# The layout follows the Postgres one, except that times are stored as
+# seconds since the epoch, and each record keeps the local day its session
+# ended on. The daily numbers are grouped from the records on the fly rather
+# than kept in a sleep_daily rollup. The running statistics of
+# online_stats.py are kept here too. The database runs in WAL mode, so
+# reports can read while an import writes.
+
+import os
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import actigraphy
+import online_stats
+import sleep_stats
+import users
+
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'sleep.db')
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sleep_records (
+        user_id TEXT NOT NULL,
+        start_time INTEGER NOT NULL,
+        end_time INTEGER,
+        day TEXT,
+        sleep_duration REAL,
+        cycles INTEGER,
+        deep_sleep REAL,
+        time_awake INTEGER,
+        location_hash TEXT,
+        comment TEXT,
+        tz TEXT,
+        PRIMARY KEY (user_id, start_time)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS sleep_records_end_time_idx ON sleep_records (user_id, end_time);
+    CREATE INDEX IF NOT EXISTS sleep_records_day_idx ON sleep_records (user_id, day);
+    CREATE TABLE IF NOT EXISTS sleep_actigraphy (
+        user_id TEXT NOT NULL,
+        start_time INTEGER NOT NULL,
+        samples BLOB,
+        events BLOB,
+        PRIMARY KEY (user_id, start_time)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS sleep_online_stats (
+        user_id TEXT PRIMARY KEY,
+        state TEXT NOT NULL,
+        updated_at TEXT
+    );
+"""
+
+RECORD_COLUMNS = [
+    'user_id', 'start_time', 'end_time', 'day', 'sleep_duration', 'cycles',
+    'deep_sleep', 'time_awake', 'location_hash', 'comment', 'tz'
+]
+
+# Same computation as sleep_stats.WINDOW_STATS_QUERY
+WINDOW_STATS_QUERY = """
+    SELECT w.value AS days,
+           COALESCE(SUM(
+               (r.end_time - r.start_time - COALESCE(r.time_awake, 0) * 60)
+               * (MIN(r.end_time, :now) - MAX(r.start_time, :now - w.value * 86400))
+               / CAST(r.end_time - r.start_time AS REAL)
+           ), 0.0) AS sleep_seconds
+    FROM json_each(:windows) AS w
+    LEFT JOIN sleep_records r
+        ON r.user_id = :user_id
+        AND r.end_time > :now - w.value * 86400
+        AND r.start_time < :now
+        AND r.end_time > r.start_time
+    GROUP BY w.value
+    ORDER BY w.value
+"""
+
+# Same columns as sleep_stats.DAILY_QUERY reads from sleep_daily
+DAILY_QUERY = """
+    SELECT day,
+           SUM(sleep_duration * 60) AS total_sleep_minutes,
+           COUNT(*) AS record_count,
+           MIN(sleep_duration * 60) AS min_session_minutes,
+           MAX(sleep_duration * 60) AS max_session_minutes,
+           SUM(sleep_duration * 60 * deep_sleep) AS deep_sleep_minutes,
+           SUM(time_awake) AS awake_minutes
+    FROM sleep_records
+    WHERE user_id = :user_id AND day > :first AND day <= :today
+    GROUP BY day
+    ORDER BY day
+"""
+
+RECORDS_QUERY = """
+    SELECT r.start_time, r.end_time, a.samples
+    FROM sleep_records r
+    LEFT JOIN sleep_actigraphy a ON a.user_id = r.user_id AND a.start_time = r.start_time
+    WHERE r.user_id = ? AND r.start_time >= ? AND r.start_time < ?
+    ORDER BY r.start_time
+"""
+
+
+@contextmanager
+def connect(path=None):
+    # Autocommit connection; writers open their own transactions
+    conn = sqlite3.connect(path or SQLITE_PATH, isolation_level=None)
+    try:
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA busy_timeout = 5000")
+        yield conn
+    finally:
+        conn.close()
+
+
+def setup(path=None):
+    with connect(path) as conn:
+        conn.executescript(SCHEMA)
+        # Outdated online stats, and users with records but none yet
+        stale = [row[0] for row in conn.execute("""
+            SELECT DISTINCT r.user_id FROM sleep_records r
+            LEFT JOIN sleep_online_stats s ON s.user_id = r.user_id
+            WHERE s.state IS NULL OR json_extract(s.state, '$.version') IS NOT ?
+        """, (online_stats.STATE_VERSION,))]
+        for user_id in stale:
+            rebuild_online_stats(conn, user_id)
+    print(f"Tables are set up in '{path or SQLITE_PATH}'.")
+
+
+def epoch(moment):
+    return int(moment.timestamp())
+
+
+def load_online_stats(conn, user_id):
+    row = conn.execute("SELECT state FROM sleep_online_stats WHERE user_id = ?", (user_id,)).fetchone()
+    return online_stats.load(row[0] if row else None)
+
+
+def save_online_stats(conn, user_id, state):
+    conn.execute("""
+        INSERT INTO sleep_online_stats (user_id, state, updated_at) VALUES (?, ?, datetime('now'))
+        ON CONFLICT (user_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at
+    """, (user_id, online_stats.dump(state)))
+
+
+def import_records(records, user_id=users.DEFAULT_USER, path=None):
+    # Inserts the records that aren't stored yet with executemany, in one
+    # transaction, and returns those along with the user's updated online
+    # stats. Actigraphy is saved for every record that has any, like
+    # import_to_db.store_actigraphy.
+    with connect(path) as conn:
+        if not records:
+            return [], load_online_stats(conn, user_id)
+        # IMMEDIATE takes the write lock up front, so nothing can insert
+        # between the lookup of existing records and the insert
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            starts = [epoch(record['start_time']) for record in records]
+            existing = {row[0] for row in conn.execute(
+                "SELECT start_time FROM sleep_records WHERE user_id = ? AND start_time BETWEEN ? AND ?",
+                (user_id, min(starts), max(starts))
+            )}
+            inserted = []
+            rows = []
+            for start, record in zip(starts, records):
+                if start in existing:
+                    continue
+                existing.add(start)
+                inserted.append(record)
+                rows.append((
+                    user_id, start, epoch(record['end_time']),
+                    # end_time is in the record's own zone
+                    record['end_time'].date().isoformat(),
+                    record['sleep_duration'], record['cycles'], record['deep_sleep'], record['time_awake'],
+                    record['location_hash'], record['comment'], record['tz']
+                ))
+            conn.executemany(
+                f"INSERT INTO sleep_records ({', '.join(RECORD_COLUMNS)}) "
+                f"VALUES ({', '.join('?' for _ in RECORD_COLUMNS)})",
+                rows
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO sleep_actigraphy (user_id, start_time, samples, events) VALUES (?, ?, ?, ?)",
+                (
+                    (user_id, start, actigraphy.pack_samples(record['actigraphy']),
+                     actigraphy.pack_events(record['events']))
+                    for start, record in zip(starts, records)
+                    if len(record.get('actigraphy', ())) or len(record.get('events', ()))
+                )
+            )
+            state = load_online_stats(conn, user_id)
+            if inserted:
+                online_stats.update(state, inserted)
+                save_online_stats(conn, user_id, state)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    return inserted, state
+
+
+def rebuild_online_stats(conn, user_id):
+    # Recomputes a user's stats from all their records, oldest night first
+    state = online_stats.new_state()
+    rows = conn.execute("""
+        SELECT day, end_time, sleep_duration, deep_sleep FROM sleep_records
+        WHERE user_id = ? ORDER BY day, end_time
+    """, (user_id,))
+    for row in rows:
+        online_stats.update(state, [dict(row)])
+    save_online_stats(conn, user_id, state)
+    print(f"Rebuilt online stats for {user_id}: {state['sessions']['count']} sessions.")
+
+
+def rebuild_all_online_stats(path=None):
+    with connect(path) as conn:
+        for (user_id,) in conn.execute("SELECT DISTINCT user_id FROM sleep_records ORDER BY 1").fetchall():
+            rebuild_online_stats(conn, user_id)
+
+
+
+def latest_start_time(user_id=users.DEFAULT_USER, path=None):
+    with connect(path) as conn:
+        latest = conn.execute("SELECT max(start_time) FROM sleep_records WHERE user_id = ?", (user_id,)).fetchone()[0]
+    return None if latest is None else datetime.fromtimestamp(latest, timezone.utc)
+
+
+def start_times_since(since, user_id=users.DEFAULT_USER, path=None):
+    with connect(path) as conn:
+        rows = conn.execute("SELECT start_time FROM sleep_records WHERE user_id = ? AND start_time > ?",
+                            (user_id, epoch(since))).fetchall()
+    return [datetime.fromtimestamp(row[0], timezone.utc) for row in rows]
+
+
+def fetch_window_stats(conn, windows, now=None, user_id=users.DEFAULT_USER):
+    # Same result as sleep_stats.fetch_window_stats
+    now = now or datetime.now(timezone.utc)
+    rows = conn.execute(WINDOW_STATS_QUERY, {
+        'windows': '[' + ','.join(str(int(days)) for days in windows) + ']',
+        'now': now.timestamp(),
+        'user_id': user_id,
+    })
+    return {row['days']: sleep_stats.window_stats(row['days'], row['sleep_seconds']) for row in rows}
+
+
+def fetch_daily(conn, days, now=None, user_id=users.DEFAULT_USER):
+    # Same result as sleep_stats.fetch_daily
+    today = (now or datetime.now(timezone.utc)).date()
+    rows = conn.execute(DAILY_QUERY, {
+        'user_id': user_id,
+        'first': (today - timedelta(days=days)).isoformat(),
+        'today': today.isoformat(),
+    })
+    return [dict(row) for row in rows]
+
+
+def fetch_least_sleep_nights(conn, windows, now=None, user_id=users.DEFAULT_USER):
+    # Same result as sleep_stats.fetch_least_sleep_nights
+    now = now or datetime.now(timezone.utc)
+    daily = fetch_daily(conn, max(windows), now, user_id)
+    least = {}
+    for days in windows:
+        first = (now.date() - timedelta(days=days)).isoformat()
+        nights = [row for row in daily if row['day'] > first]
+        if nights:
+            night = min(nights, key=lambda row: row['total_sleep_minutes'])
+            least[days] = {'day': night['day'], 'total_sleep_minutes': night['total_sleep_minutes']}
+    return least
+
+
+def fetch_records(conn, start, end, user_id=users.DEFAULT_USER):
+    # Records starting in [start, end) with their actigraphy, shaped like
+    # analysis.load_sleep_records' (UTC times)
+    return [
+        {
+            'start_time': datetime.fromtimestamp(row['start_time'], timezone.utc),
+            'end_time': datetime.fromtimestamp(row['end_time'], timezone.utc),
+            'actigraphy': actigraphy.unpack_samples(row['samples'] or b''),
+        }
+        for row in conn.execute(RECORDS_QUERY, (user_id, epoch(start), epoch(end)))
+    ]
@@ -0,0 +1,71 @@
+from aiohttp import web
+import asyncio
+import time
+
+from discord_dispatcher import DiscordDispatcher, MAX_FIELDS_PER_EMBED, MAX_EMBED_CHARS
+
+def fake_record_field(index):
+    return {
+        "name": f"🌙 Sleep Record: <t:{1700000000 + index * 86400}:f>",
+        "value": "⏰ End: <t:1700028800:t>\n⌛ Duration: 7h 30m\n👀 Awake: 5.0% ░░░░░░░░░░\n"
+                 "💤 Deep sleep: 40.0% ████░░░░░░\n🛌 Efficiency: 90% █████████░\n"
+                 "🧩 Longest stretch: 2h 10m, ~5 cycles\n"
+    }
+
+async def run_stub_webhook(rate_limit_every=3, retry_after=0.2):
+    # Local stand-in for the Discord webhook: records every payload and
+    # answers every Nth request with a 429 + Retry-After
+    received = []
+    requests_seen = 0
+
+    async def webhook(request):
+        nonlocal requests_seen
+        requests_seen += 1
+        if requests_seen % rate_limit_every == 0:
+            return web.json_response({"retry_after": retry_after}, status=429,
+                                     headers={"Retry-After": str(retry_after)})
+        received.append((time.monotonic(), await request.json()))
+        return web.Response(status=204)
+
+    app = web.Application()
+    app.router.add_post('/webhook', webhook)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}/webhook", received
+
+async def check_dispatcher(records=80):
+    runner, url, received = await run_stub_webhook()
+    dispatcher = DiscordDispatcher(url)
+    await dispatcher.start()
+    try:
+        fields = [fake_record_field(index) for index in range(records)]
+        start = time.monotonic()
+        dispatcher.notify(f"New sleep data! {records} new records.", fields)
+        dispatcher.notify("Sleep tracking started!")
+        # notify() only queues, it must not wait on the webhook
+        assert time.monotonic() - start < 0.05
+        await asyncio.wait_for(dispatcher.queue.join(), 10)
+    finally:
+        await dispatcher.stop()
+        await runner.cleanup()
+
+    embeds = [payload["embeds"][0] for _, payload in received]
+    sent_fields = [field for embed in embeds[:-1] for field in embed["fields"]]
+    print(f"{records} fields went out in {len(embeds) - 1} embeds, then the follow-up message")
+    assert sent_fields == fields, "fields lost, duplicated or reordered"
+    assert embeds[-1]["description"] == "Sleep tracking started!"
+    for embed in embeds:
+        assert len(embed["fields"]) <= MAX_FIELDS_PER_EMBED
+        size = len(embed["title"]) + len(embed["description"])
+        size += sum(len(field["name"]) + len(field["value"]) for field in embed["fields"])
+        assert size <= MAX_EMBED_CHARS
+
+def test_discord_dispatcher():
+    asyncio.run(check_dispatcher())
+
+if __name__ == "__main__":
+    test_discord_dispatcher()
+    print("Discord dispatcher OK")
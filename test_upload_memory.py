@@ -0,0 +1,77 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+from aiohttp import web
+
+import upload_jobs
+from benchmarks.bench_upload_memory import CHUNK, body, peak_rss_mb
+
+def rss_mb():
+    # Current (not peak) RSS: measuring from the peak would hide growth below
+    # whatever the process peaked at while starting up
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+
+
+# Peak RSS growth allowed while receiving an upload: the in-memory part
+# (UPLOAD_MEMORY_LIMIT) plus room for aiohttp's buffers, whatever the size
+MAX_GROWTH_MB = upload_jobs.UPLOAD_MEMORY_LIMIT / 1024**2 + 32
+
+
+async def handle_upload(request):
+    data, size, digest = await upload_jobs.receive_upload(request.content)
+    try:
+        spooled = isinstance(data, str)
+        stored = os.path.getsize(data) if spooled else len(data)
+        return web.json_response({"size": size, "stored": stored, "digest": digest, "spooled": spooled})
+    finally:
+        upload_jobs.discard_upload(data)
+
+
+async def receive(megabytes):
+    app = web.Application(client_max_size=upload_jobs.UPLOAD_MAX_BYTES)
+    app.router.add_post('/upload', handle_upload)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            baseline = rss_mb()
+            async with session.post(f"http://127.0.0.1:{runner.addresses[0][1]}/upload",
+                                    data=body(megabytes)) as response:
+                result = await response.json()
+            result['growth_mb'] = peak_rss_mb() - baseline
+    finally:
+        await runner.cleanup()
+    return result
+
+
+def measure_upload(megabytes):
+    result = asyncio.run(receive(megabytes))
+    # CHUNK is random per process, so the expected digest is worked out here
+    expected = hashlib.sha256()
+    for _ in range(megabytes):
+        expected.update(CHUNK)
+    result['expected_digest'] = expected.hexdigest()
+    return result
+
+
+def test_upload_memory():
+    # Each size in a fresh process, since peak RSS never goes back down
+    limit_mb = upload_jobs.UPLOAD_MEMORY_LIMIT // 1024**2
+    growths = {}
+    for megabytes in (limit_mb + 8, limit_mb * 16):
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            result = executor.submit(measure_upload, megabytes).result()
+        print(f"{megabytes}MB upload: peak RSS grew {result['growth_mb']:.0f}MB")
+        assert result['spooled'], f"a {megabytes}MB upload was kept in memory"
+        assert result['size'] == result['stored'] == megabytes * 1024**2
+        assert result['digest'] == result['expected_digest']
+        growths[megabytes] = result['growth_mb']
+
+    assert max(growths.values()) < MAX_GROWTH_MB, f"peak RSS grew by {growths} MB"
@@ -1,21 +1,142 @@
+import os
+
+# Before http_server reads its settings: its own database, no Discord messages
+os.environ.setdefault('DB_NAME', 'sleep_test')
+os.environ['DISCORD_WEBHOOK'] = ''
+
 import aiohttp
 import asyncio
+import argparse
+import time
+
+import pytest
+
+from benchmarks import synthetic
 
-async def test_upload():
-    url = 'http://192.168.0.52:9292/upload'
-    filename = 'sleep-export.zip'
+def auth_headers(token=None):
+    # Servers with UPLOAD_TOKENS set want the user's token on every request
+    token = token or os.getenv('UPLOAD_TOKEN')
+    return {'Authorization': f'Bearer {token}'} if token else {}
 
-    async with aiohttp.ClientSession() as session:
-        with open(filename, 'rb') as f:
-            data = f.read()
+async def wait_for_job(session, url, job, interval=0.2):
+    # /upload answers 202 right away; poll the job until it's finished
+    status_url = url.rsplit('/', 1)[0] + job['status_url']
+    while True:
+        async with session.get(status_url) as response:
+            status = await response.json()
+        if status['status'] in ('done', 'failed'):
+            return status
+        await asyncio.sleep(interval)
 
+async def upload(url, data, repeat=1, token=None):
+    # Uploads data repeat times and returns each finished job's status (None
+    # for an upload answered straight from the digest cache)
+    async with aiohttp.ClientSession(headers=auth_headers(token)) as session:
         headers = {'Content-Type': 'application/zip'}
 
-        print(f"Uploading {filename} to {url}")
-        async with session.post(url, data=data, headers=headers) as response:
-            print(f"Status: {response.status}")
-            print("Response:")
-            print(await response.text())
+        # The first upload after a server (re)start is the cold one; the rest
+        # reuse the server's connection pool and already set up schema
+        latencies = []
+        statuses = []
+        for attempt in range(repeat):
+            print(f"Uploading {len(data)} bytes to {url}")
+            start = time.perf_counter()
+            async with session.post(url, data=data, headers=headers) as response:
+                print(f"Status: {response.status}")
+                print("Response:")
+                print(await response.text())
+                assert response.status in (200, 202), f"upload failed with {response.status}"
+                job = await response.json() if response.status == 202 else None
+            print(f"Accepted after {(time.perf_counter() - start) * 1000:.1f}ms")
+            status = None
+            if job:
+                status = await wait_for_job(session, url, job)
+                print(f"Job {status['id']} {status['status']}: {status['result'] or status['error']}")
+                print(f"Progress: {status['progress']}")
+                print(f"Timings: {status['timings']}")
+            statuses.append(status)
+            latencies.append(time.perf_counter() - start)
+            print(f"Upload {attempt + 1} took {latencies[-1] * 1000:.1f}ms")
+
+        if repeat > 1:
+            warm = latencies[1:]
+            print(f"Cold: {latencies[0] * 1000:.1f}ms, warm avg: {sum(warm) / len(warm) * 1000:.1f}ms over {len(warm)} uploads")
+    return statuses
+
+async def probe_sleep_start(session, url, stop, latencies, interval=0.1):
+    while not stop.is_set():
+        start = time.perf_counter()
+        async with session.get(url) as response:
+            await response.read()
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(interval)
+
+async def check_sleep_start_responsive(url, data, max_latency=0.5, token=None):
+    # Uploads a (large) export while hitting /sleep-start in a loop. Parsing
+    # runs in the server's executor, so /sleep-start should keep answering
+    # quickly. Point it at a dev server: every probe sends a Discord message
+    # if DISCORD_WEBHOOK is set there.
+    sleep_start_url = url.rsplit('/', 1)[0] + '/sleep-start'
+
+    async with aiohttp.ClientSession(headers=auth_headers(token)) as session:
+        stop = asyncio.Event()
+        latencies = []
+        probe = asyncio.create_task(probe_sleep_start(session, sleep_start_url, stop, latencies))
+        # full_rescan skips the digest cache, so the export is parsed every time
+        async with session.post(url, params={'full_rescan': '1'}, data=data,
+                                headers={'Content-Type': 'application/zip'}) as response:
+            print(f"Upload status: {response.status}")
+            job = await response.json()
+        status = await wait_for_job(session, url, job)
+        stop.set()
+        await probe
+
+    worst = max(latencies)
+    print(f"/sleep-start answered {len(latencies)} times during the upload, worst {worst * 1000:.1f}ms")
+    assert status['status'] == 'done', status['error']
+    assert worst < max_latency, f"/sleep-start took {worst:.3f}s during an upload"
+
+async def run_local_server(check):
+    # Runs check(upload_url) against http_server's app in this process, using
+    # the usual DB_* settings. Skipped when that database isn't reachable.
+    from aiohttp.test_utils import TestServer
+    import http_server
+
+    async with TestServer(http_server.app) as server:
+        try:
+            await http_server.pipeline_ready(server.app)
+        except Exception as e:
+            pytest.skip(f"database '{os.environ['DB_NAME']}' is not available: {e}")
+        await check(str(server.make_url('/upload')))
+
+async def check_server(url):
+    data = synthetic.generate_zip(years=5)
+    # full_rescan: the records may be in the test database from an earlier run
+    statuses = await upload(url + '?full_rescan=1', data)
+    assert statuses[0]['status'] == 'done', statuses[0]['error']
+    assert statuses[0]['progress']['records_parsed'] > 1500
+    # The same bytes again are answered from the digest cache
+    assert await upload(url, data) == [None]
+    await check_sleep_start_responsive(url, data)
+
+def test_upload_server():
+    # One server for all checks: http_server.app can only run once per process
+    asyncio.run(run_local_server(check_server))
 
 if __name__ == "__main__":
-    asyncio.run(test_upload())
+    parser = argparse.ArgumentParser(description="Upload a sleep export to a running server and time it")
+    parser.add_argument('--url', default=os.getenv('UPLOAD_URL', 'http://localhost:9292/upload'),
+                        help="upload endpoint (defaults to $UPLOAD_URL)")
+    parser.add_argument('--file', default='sleep-export.zip')
+    parser.add_argument('--token', help="upload token (defaults to $UPLOAD_TOKEN)")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="upload this many times to compare cold vs warm latency")
+    parser.add_argument('--check-responsive', action='store_true',
+                        help="check /sleep-start stays responsive while the upload is processed")
+    args = parser.parse_args()
+    with open(args.file, 'rb') as f:
+        data = f.read()
+    if args.check_responsive:
+        asyncio.run(check_sleep_start_responsive(args.url, data, token=args.token))
+    else:
+        asyncio.run(upload(args.url, data, args.repeat, args.token))
@@ -0,0 +1,84 @@
+# =-=-=-=-==-=-=-=
+# Timezone Cache
+# =-=-=-=-==-=-=-=
+#
+# Turning an export's wall-clock "To"/"From" times into instants used to cost
+# a pytz.timezone() lookup and a localize() per record, although a user's
+# history only has a handful of zones. Here zones are looked up once and the
+# UTC offset is memoized per (zone, local wall-clock minute), so a localize is
+# a dict lookup plus a datetime replace.
+#
+# The dict parsers and the columnar loader (sleep_columns.py) all resolve
+# offsets here. They follow pytz's localize(is_dst=False), which the parsers
+# used before:
+#
+#   ambiguous times (DST fold)  standard time, i.e. the later instant
+#   non-existent times (gap)    the offset from before the jump
+#
+# The stdlib zoneinfo is used when it has the zone, and pytz otherwise (the
+# Alpine image has no system tz database). TZ_BACKEND=pytz forces pytz.
+
+import os
+from datetime import datetime, timedelta, timezone as dt_timezone
+from functools import lru_cache
+
+import pytz
+
+try:
+    import zoneinfo
+except ImportError:
+    zoneinfo = None
+
+TZ_BACKEND = os.getenv('TZ_BACKEND', 'zoneinfo')
+EPOCH = datetime(1970, 1, 1)
+ONE_MINUTE = timedelta(minutes=1)
+
+
+@lru_cache(maxsize=None)
+def get_zone(name):
+    # zoneinfo.ZoneInfo when available, else the pytz zone
+    if TZ_BACKEND == 'zoneinfo' and zoneinfo is not None:
+        try:
+            return zoneinfo.ZoneInfo(name)
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+            pass
+    return pytz.timezone(name)
+
+
+@lru_cache(maxsize=None)
+def fixed_offset(seconds):
+    return dt_timezone(timedelta(seconds=seconds))
+
+
+@lru_cache(maxsize=65536)
+def utc_offset_seconds(name, local_minute):
+    # UTC offset of the wall-clock minute local_minute (minutes since
+    # 1970-01-01 00:00 local time) in zone name
+    naive = EPOCH + local_minute * ONE_MINUTE
+    zone = get_zone(name)
+    if isinstance(zone, pytz.BaseTzInfo):
+        return int(zone.localize(naive, is_dst=False).utcoffset().total_seconds())
+
+    before = naive.replace(tzinfo=zone, fold=0)
+    after = naive.replace(tzinfo=zone, fold=1)
+    if before.utcoffset() == after.utcoffset():
+        return int(before.utcoffset().total_seconds())
+
+    # A fold or a gap: keep the candidates that really show this wall time
+    candidates = []
+    for aware in (before, after):
+        instant = (naive - aware.utcoffset()).replace(tzinfo=dt_timezone.utc)
+        if instant.astimezone(zone).replace(tzinfo=None) == naive:
+            candidates.append((not aware.dst(), instant, aware.utcoffset()))
+    if not candidates:
+        # Gap: fold=0 gives the offset in effect before the transition
+        return int(before.utcoffset().total_seconds())
+    # Prefer standard time, then the later instant
+    return int(max(candidates)[2].total_seconds())
+
+
+def localize(naive, name):
+    # naive wall-clock datetime in zone name -> aware datetime at the right
+    # instant (with a fixed offset tzinfo, so the wall-clock time is kept)
+    offset = utc_offset_seconds(name, (naive - EPOCH) // ONE_MINUTE)
+    return naive.replace(tzinfo=fixed_offset(offset))
@@ -0,0 +1,250 @@
+# =-=-=-=-==-=-=-=
+# Upload Job Queue
+# =-=-=-=-==-=-=-=
+#
+# /upload only stores the archive and answers 202 with a job id; the actual
+# extract -> parse -> import -> notify work runs in background worker tasks
+# that take jobs off a bounded queue in the order they arrived. One user's
+# jobs run one at a time, in order; different users' jobs run in parallel.
+# Clients poll GET /jobs/{id} for the job's progress.
+#
+# Jobs are plain dicts so they can be returned as JSON as they are:
+#
+#   status    queued, running, done or failed
+#   stage     the stage currently running (extract_parse, import, notify)
+#   progress  bytes_received, bytes_extracted, records_parsed, records_inserted
+#   timings   seconds spent per stage, plus queued and total
+#
+# The body is streamed off the socket in chunks and hashed as it arrives.
+# Small uploads stay in memory; past UPLOAD_MEMORY_LIMIT it's spooled to a
+# temp file and the job carries the file's path, which the extractor opens in
+# place. Either way only one copy of the archive exists.
+#
+# Uploads from the same user with the same content (sha256) as a job that's
+# still queued or running get that job's id back instead of a new job, so a phone re-sending
+# an archive after a timeout doesn't import it twice. Digests of finished
+# uploads go in DigestCache (a small in-memory LRU in front of the
+# upload_digests table), and a re-upload of one of those is answered straight
+# away with the earlier result.
+
+import asyncio
+import hashlib
+import io
+import os
+import tempfile
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timezone
+
+# Finished jobs kept around for GET /jobs/{id}
+JOB_HISTORY = 100
+# Bytes of an upload held in memory before it's spooled to disk
+UPLOAD_MEMORY_LIMIT = int(os.getenv('UPLOAD_MEMORY_LIMIT', str(16 * 1024**2)))
+# Largest upload accepted at all
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', str(1024**3)))
+# Recent upload digests kept in memory (older ones are looked up in Postgres)
+DIGEST_CACHE_SIZE = int(os.getenv('DIGEST_CACHE_SIZE', '256'))
+# Where spooled uploads go (defaults to the system temp dir)
+UPLOAD_SPOOL_DIR = os.getenv('UPLOAD_SPOOL_DIR') or None
+CHUNK_SIZE = 256 * 1024
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+async def receive_upload(content, memory_limit=UPLOAD_MEMORY_LIMIT, max_bytes=UPLOAD_MAX_BYTES,
+                         spool_dir=UPLOAD_SPOOL_DIR):
+    # Reads an aiohttp StreamReader in chunks. Returns (data, size, digest)
+    # where data is bytes, or the path of a temp file once the upload grew
+    # past memory_limit (remove it with discard_upload when done).
+    digest = hashlib.sha256()
+    buffer = io.BytesIO()
+    spool = None
+    size = 0
+    try:
+        async for chunk in content.iter_chunked(CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(f"Upload is larger than {max_bytes} bytes")
+            digest.update(chunk)
+            if spool is None and size > memory_limit:
+                spool = tempfile.NamedTemporaryFile(prefix='upload-', suffix='.zip', dir=spool_dir, delete=False)
+                spool.write(buffer.getbuffer())
+                buffer = None
+            if spool is not None:
+                spool.write(chunk)
+            else:
+                buffer.write(chunk)
+    except BaseException:
+        if spool is not None:
+            spool.close()
+            os.remove(spool.name)
+        raise
+
+    if spool is None:
+        return buffer.getvalue(), size, digest.hexdigest()
+    spool.close()
+    return spool.name, size, digest.hexdigest()
+
+
+def discard_upload(data):
+    # Removes a spooled upload; in-memory ones just get dropped
+    if isinstance(data, str):
+        try:
+            os.remove(data)
+        except FileNotFoundError:
+            pass
+
+
+def new_job(user_id, digest, size, full_rescan=False):
+    return {
+        "id": uuid.uuid4().hex,
+        "user_id": user_id,
+        "status": "queued",
+        "stage": None,
+        "digest": digest,
+        "full_rescan": full_rescan,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "progress": {
+            "bytes_received": size,
+            "bytes_extracted": None,
+            "records_parsed": None,
+            "records_inserted": None,
+        },
+        "timings": {},
+        "result": None,
+        "error": None,
+    }
+
+
+class DigestCache:
+    def __init__(self, pool, size=DIGEST_CACHE_SIZE):
+        self.pool = pool
+        self.size = size
+        self.entries = OrderedDict()
+
+    async def get(self, user_id, digest):
+        # The stored result for an upload of this user with this digest, or None
+        entry = self.entries.get((user_id, digest))
+        if entry is None:
+            row = await self.pool.fetchrow("""
+                SELECT user_id, digest, size, result, records_parsed, records_inserted
+                FROM upload_digests WHERE user_id = $1 AND digest = $2
+            """, user_id, digest)
+            if row is None:
+                return None
+            entry = dict(row)
+        self.remember(entry)
+        await self.pool.execute(
+            "UPDATE upload_digests SET hits = hits + 1, last_seen = now() WHERE user_id = $1 AND digest = $2",
+            user_id, digest
+        )
+        return entry
+
+    async def put(self, job):
+        # Records a finished job's result under its upload's digest
+        entry = {
+            "user_id": job['user_id'],
+            "digest": job['digest'],
+            "size": job['progress']['bytes_received'],
+            "result": job['result'],
+            "records_parsed": job['progress']['records_parsed'],
+            "records_inserted": job['progress']['records_inserted'],
+        }
+        await self.pool.execute("""
+            INSERT INTO upload_digests (user_id, digest, size, result, records_parsed, records_inserted)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            ON CONFLICT (user_id, digest) DO UPDATE SET last_seen = now()
+        """, *entry.values())
+        self.remember(entry)
+
+    def remember(self, entry):
+        key = (entry['user_id'], entry['digest'])
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class UploadJobs:
+    def __init__(self, handler, max_queued=4, workers=2, history=JOB_HISTORY):
+        # handler(job, data) does the work for one job and returns a short
+        # result message; raising marks the job as failed
+        self.handler = handler
+        self.workers = workers
+        self.history = history
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        self.jobs = OrderedDict()
+        self.active = {}
+        self.user_locks = defaultdict(asyncio.Lock)
+        self.tasks = []
+
+    async def start(self):
+        self.tasks = [asyncio.create_task(self.run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        # Don't leave spooled uploads of jobs that never ran behind
+        while not self.queue.empty():
+            job, data, _ = self.queue.get_nowait()
+            discard_upload(data)
+
+    def submit(self, user_id, data, size, digest, full_rescan=False):
+        # data/size/digest as returned by receive_upload. Returns (job, duplicate)
+        # and takes ownership of data. Raises asyncio.QueueFull when the queue
+        # is full (data is left to the caller then).
+        existing = self.active.get((user_id, digest))
+        if existing is not None and existing['full_rescan'] == full_rescan:
+            print(f"Upload matches job {existing['id']} ({existing['status']}), not queueing it again")
+            discard_upload(data)
+            return existing, True
+
+        job = new_job(user_id, digest, size, full_rescan)
+        self.queue.put_nowait((job, data, time.perf_counter()))
+        self.jobs[job['id']] = job
+        self.active[(user_id, digest)] = job
+        self.prune()
+        print(f"Queued upload job {job['id']} ({size} bytes, {self.queue.qsize()} waiting)")
+        return job, False
+
+    def get(self, job_id, user_id):
+        # Users only get to see their own jobs
+        job = self.jobs.get(job_id)
+        return job if job is not None and job['user_id'] == user_id else None
+
+    def prune(self):
+        # Drops the oldest finished jobs beyond the history limit
+        finished = [job_id for job_id, job in self.jobs.items() if job['status'] in ('done', 'failed')]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[job_id]
+
+    async def run(self):
+        while True:
+            job, data, queued_at = await self.queue.get()
+            # Taking the lock before anything can yield keeps a user's jobs in
+            # queue order even with several workers
+            lock = self.user_locks[job['user_id']]
+            start = time.perf_counter()
+            try:
+                async with lock:
+                    job['timings']['queued'] = round(time.perf_counter() - queued_at, 3)
+                    job['status'] = 'running'
+                    job['result'] = await self.handler(job, data)
+                job['status'] = 'done'
+            except Exception as e:
+                print(f"Upload job {job['id']} failed: {e}")
+                job['status'] = 'failed'
+                job['error'] = job['error'] or str(e)
+            finally:
+                discard_upload(data)
+                del data
+                job['stage'] = None
+                job['timings']['total'] = round(time.perf_counter() - start, 3)
+                if self.active.get((job['user_id'], job['digest'])) is job:
+                    del self.active[(job['user_id'], job['digest'])]
+                self.queue.task_done()
+            print(f"Upload job {job['id']} {job['status']} in {job['timings']['total']:.3f}s")
@@ -0,0 +1,85 @@
+# =-=-=-=-==-=-=
+# Users & Tokens
+# =-=-=-=-==-=-=
+#
+# Several people (or devices) can share one server. Each gets a token, set in
+# UPLOAD_TOKENS as comma separated token:user_id pairs:
+#
+#   UPLOAD_TOKENS=3f9c0a...:alice,81d2e7...:bob
+#
+# Requests authenticate with "Authorization: Bearer <token>" or ?token=<token>
+# (for apps that only let you configure a URL). Every record, daily rollup
+# row and upload digest is keyed by user_id, and sleep_records is partitioned
+# by it, so one user's imports and stats only touch their own partition.
+#
+# Without UPLOAD_TOKENS the server stays single-user and unauthenticated, and
+# everything belongs to DEFAULT_USER (which is also who records from before
+# users existed are migrated to).
+
+import hashlib
+import hmac
+import os
+import re
+
+DEFAULT_USER = os.getenv('DEFAULT_USER', 'default')
+USER_ID = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+
+def parse_tokens(value):
+    # 'token1:alice,token2:bob' -> {'token1': 'alice', 'token2': 'bob'}
+    tokens = {}
+    for pair in (value or '').split(','):
+        if not pair.strip():
+            continue
+        token, _, user_id = pair.strip().partition(':')
+        if not token or not USER_ID.match(user_id):
+            raise ValueError(f"Invalid UPLOAD_TOKENS entry for user {user_id!r}")
+        tokens[token] = user_id
+    return tokens
+
+
+if not USER_ID.match(DEFAULT_USER):
+    raise ValueError(f"Invalid DEFAULT_USER {DEFAULT_USER!r}")
+
+TOKENS = parse_tokens(os.getenv('UPLOAD_TOKENS'))
+MULTI_USER = bool(TOKENS)
+
+
+def all_users():
+    return sorted(set(TOKENS.values()) | {DEFAULT_USER})
+
+
+def user_for_token(token):
+    # The user a token belongs to, DEFAULT_USER in single-user mode, or None.
+    # Every configured token is compared in constant time, so response times
+    # don't give away how much of a guess was right.
+    if not MULTI_USER:
+        return DEFAULT_USER
+    if not token:
+        return None
+    found = None
+    for candidate, user_id in TOKENS.items():
+        if hmac.compare_digest(candidate.encode(), token.encode()):
+            found = user_id
+    return found
+
+
+def request_token(headers, query):
+    authorization = headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        return authorization[len('Bearer '):].strip()
+    return query.get('token')
+
+
+def partition_name(user_id):
+    # sleep_records partition for a user. The hash keeps names unique for
+    # user_ids that only differ in characters that get replaced.
+    slug = re.sub(r'[^a-z0-9]', '_', user_id.lower())[:32]
+    suffix = hashlib.sha1(user_id.encode()).hexdigest()[:8]
+    return f"sleep_records_{slug}_{suffix}"
+
+
+def quote_literal(value):
+    # Partition bounds are DDL and can't be query parameters; user_ids are
+    # validated against USER_ID before they get here anyway
+    return "'" + value.replace("'", "''") + "'"